@@ -1,9 +1,27 @@
 import os
+import sys
+import csv
+import time
+import shutil
+import tempfile
+import atexit
+import argparse
+import hashlib
+import json
+import collections
+import contextlib
+try:
+  import resource
+except ImportError:
+  resource = None  # not available on Windows
 import unittest
 import vtk, qt, ctk, slicer
+from vtk.util import numpy_support
 from slicer.ScriptedLoadableModule import *
 import logging
 import subprocess
+import threading
+import multiprocessing.pool
 import numpy
 
 #
@@ -116,6 +134,46 @@ class StaticNeedleSegmentationWidget(ScriptedLoadableModuleWidget):
     self.applyButton.enabled = False
     parametersFormLayout.addRow(self.applyButton)
 
+    #
+    # check box to re-segment the image whenever it is updated
+    #
+    self.enableTrackingFlagCheckBox = qt.QCheckBox()
+    self.enableTrackingFlagCheckBox.checked = 0
+    self.enableTrackingFlagCheckBox.enabled = False
+    self.enableTrackingFlagCheckBox.setToolTip("If checked, the image is segmented again every time it is updated (e.g. through OpenIGTLink), starting from the previous result.")
+    self.trackingStatusLabel = qt.QLabel()
+    trackingLayout = qt.QHBoxLayout()
+    trackingLayout.addWidget(self.enableTrackingFlagCheckBox)
+    trackingLayout.addWidget(self.trackingStatusLabel, 1)
+    parametersFormLayout.addRow("Track Image Updates", trackingLayout)
+
+    #
+    # check box to update the segmentation when the seed is moved
+    #
+    self.enableSeedWatchFlagCheckBox = qt.QCheckBox()
+    self.enableSeedWatchFlagCheckBox.checked = 0
+    self.enableSeedWatchFlagCheckBox.enabled = False
+    self.enableSeedWatchFlagCheckBox.setToolTip("If checked, the segmentation is updated when the seed is moved. Seeds that stay on the segmented needle reuse the result, others are segmented again in a region around the previous needle.")
+    self.seedWatchStatusLabel = qt.QLabel()
+    seedWatchLayout = qt.QHBoxLayout()
+    seedWatchLayout.addWidget(self.enableSeedWatchFlagCheckBox)
+    seedWatchLayout.addWidget(self.seedWatchStatusLabel, 1)
+    parametersFormLayout.addRow("Update On Seed Move", seedWatchLayout)
+
+    #
+    # Progress bar and Cancel button, shown while a segmentation is running
+    #
+    self.progressBar = qt.QProgressBar()
+    self.progressBar.setRange(0, 100)
+    self.progressBar.visible = False
+    self.cancelButton = qt.QPushButton("Cancel")
+    self.cancelButton.toolTip = "Stop the running segmentation."
+    self.cancelButton.visible = False
+    progressLayout = qt.QHBoxLayout()
+    progressLayout.addWidget(self.progressBar)
+    progressLayout.addWidget(self.cancelButton)
+    parametersFormLayout.addRow(progressLayout)
+
     #
     # Advanced Area
     #
@@ -149,6 +207,14 @@ class StaticNeedleSegmentationWidget(ScriptedLoadableModuleWidget):
     self.numToAddSliderWidget.toolTip = "Input the expected insertion angle relative to the A-P axis."
     advancedFormLayout.addRow("Expected Insertion Angle: ", self.numToAddSliderWidget)
 
+    #
+    # check box to segment a needle for each seed
+    #
+    self.enableMultiSeedFlagCheckBox = qt.QCheckBox()
+    self.enableMultiSeedFlagCheckBox.checked = 0
+    self.enableMultiSeedFlagCheckBox.setToolTip("If checked, a needle is segmented for every point of the seed markups, from a single exported image. Output points are labelled Tip N and Tail N for seed N.")
+    advancedFormLayout.addRow("Segment All Seeds", self.enableMultiSeedFlagCheckBox)
+
     #
     # check box to select if models of segmentations should be generated
     #
@@ -157,8 +223,59 @@ class StaticNeedleSegmentationWidget(ScriptedLoadableModuleWidget):
     self.enableNeedleModelsFlagCheckBox.setToolTip("If checked, models are generated from points defining segmentations.")
     advancedFormLayout.addRow("Generate Needle Models", self.enableNeedleModelsFlagCheckBox)
 
+    #
+    # check box to only export a region around the seed point
+    #
+    self.enableRoiFlagCheckBox = qt.QCheckBox()
+    self.enableRoiFlagCheckBox.checked = 0
+    self.enableRoiFlagCheckBox.setToolTip("If checked, only a box around the seed point, elongated along the expected insertion angle, is segmented.")
+    advancedFormLayout.addRow("Crop To Seed Region", self.enableRoiFlagCheckBox)
+
+    self.roiLengthSliderWidget = ctk.ctkSliderWidget()
+    self.roiLengthSliderWidget.singleStep = 10.0
+    self.roiLengthSliderWidget.minimum = 10.0
+    self.roiLengthSliderWidget.maximum = 300.0
+    self.roiLengthSliderWidget.value = 120.0
+    self.roiLengthSliderWidget.suffix = " mm"
+    self.roiLengthSliderWidget.toolTip = "Length of the cropped region along the expected needle direction."
+    advancedFormLayout.addRow("Seed Region Length: ", self.roiLengthSliderWidget)
+
+    #
+    # check box to segment a downsampled image before the full resolution one
+    #
+    self.enablePyramidFlagCheckBox = qt.QCheckBox()
+    self.enablePyramidFlagCheckBox.checked = 0
+    self.enablePyramidFlagCheckBox.setToolTip("If checked, a downsampled copy of the image is segmented first, then only a full resolution region around the result.")
+    advancedFormLayout.addRow("Coarse To Fine", self.enablePyramidFlagCheckBox)
+
+    #
+    # check box to write the image without copying or compressing it
+    #
+    self.enableRawExportFlagCheckBox = qt.QCheckBox()
+    self.enableRawExportFlagCheckBox.checked = 0
+    self.enableRawExportFlagCheckBox.setToolTip("If checked, the image is passed to the segmentation as an uncompressed .mhd/.raw pair written directly from the volume, without an intermediate copy.")
+    advancedFormLayout.addRow("Fast Raw Export", self.enableRawExportFlagCheckBox)
+
+    #
+    # segmentation algorithm
+    #
+    self.backendSelector = qt.QComboBox()
+    advancedFormLayout.addRow("Segmentation Method: ", self.backendSelector)
+
+    #
+    # directory for temporary files exchanged with the segmentation executable
+    #
+    self.scratchDirectorySelector = ctk.ctkPathLineEdit()
+    self.scratchDirectorySelector.filters = ctk.ctkPathLineEdit.Dirs
+    self.scratchDirectorySelector.setToolTip("Directory for temporary files, e.g. a RAM disk such as /dev/shm. Leave empty to use the system temporary directory.")
+    advancedFormLayout.addRow("Scratch Directory: ", self.scratchDirectorySelector)
+
     # connections
     self.applyButton.connect('clicked(bool)', self.onApplyButton)
+    self.cancelButton.connect('clicked(bool)', self.onCancelButton)
+    self.enableTrackingFlagCheckBox.connect('toggled(bool)', self.onTrackingToggled)
+    self.enableSeedWatchFlagCheckBox.connect('toggled(bool)', self.onSeedWatchToggled)
+    self.scratchDirectorySelector.connect('currentPathChanged(QString)', self.onScratchDirectoryChanged)
     self.imageSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.seedSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.outputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
@@ -167,22 +284,1056 @@ class StaticNeedleSegmentationWidget(ScriptedLoadableModuleWidget):
     # Add vertical spacer
     self.layout.addStretch(1)
 
+    # Keep a single logic instance so that state cached between runs (e.g. exported images) is reused
+    self.logic = StaticNeedleSegmentationLogic()
+
+    if self.logic.scratchRoot:
+      self.scratchDirectorySelector.currentPath = self.logic.scratchRoot
+    self.updateBackendSelector()
+
     # Refresh Apply button state
     self.onSelect()
 
   def cleanup(self):
-    pass
+    self.logic.cancelRun()
+    self.logic.cleanup()
 
   def onSelect(self):
-    self.applyButton.enabled = self.imageSelector.currentNode() and self.seedSelector.currentNode() and self.outputSelector.currentNode()
+    inputsSelected = bool(self.imageSelector.currentNode() and self.seedSelector.currentNode() and self.outputSelector.currentNode())
+    if self.logic.isTracking() and (not inputsSelected or self.logic.tracker.inputVolume != self.imageSelector.currentNode()):
+      self.enableTrackingFlagCheckBox.checked = False
+    if self.logic.isWatchingSeed() and (not inputsSelected or self.logic.seedWatcher.inputVolume != self.imageSelector.currentNode()
+                                        or self.logic.seedWatcher.inputSeedFiducial != self.seedSelector.currentNode()):
+      self.enableSeedWatchFlagCheckBox.checked = False
+    self.applyButton.enabled = not self.logic.isRunning() and not self.logic.isTracking() and inputsSelected
+    self.enableTrackingFlagCheckBox.enabled = inputsSelected
+    self.enableSeedWatchFlagCheckBox.enabled = inputsSelected
+
+  def updateLogicParameters(self):
+    """Passes the advanced settings to the logic
+    """
+    self.logic.roiLength = self.roiLengthSliderWidget.value
+    self.logic.exportFormat = 'raw' if self.enableRawExportFlagCheckBox.checked else 'mha'
+    self.logic.backendName = self.backendSelector.currentText
+
+  def updateBackendSelector(self):
+    """Lists the backends of the logic, to be called again when a backend is registered later
+    """
+    currentName = self.backendSelector.currentText or self.logic.backendName
+    self.backendSelector.clear()
+    for backend in self.logic.backends.values():
+      self.backendSelector.addItem(backend.name)
+    self.backendSelector.setCurrentIndex(max(self.backendSelector.findText(currentName), 0))
+    self.backendSelector.setToolTip("Segmentation algorithm: " +
+                                    "; ".join(backend.name + ": " + backend.description for backend in self.logic.backends.values()))
+
+  def onTrackingToggled(self, enabled):
+    if not enabled:
+      self.logic.stopTracking()
+      self.trackingStatusLabel.text = ""
+      self.onSelect()
+      return
+    self.updateLogicParameters()
+    self.logic.startTracking(self.imageSelector.currentNode(), self.seedSelector.currentNode(),
+                             self.outputSelector.currentNode(), self.numToAddSliderWidget.value,
+                             self.enableRoiFlagCheckBox.checked, statusCallback=self.onTrackingStatus)
+    self.trackingStatusLabel.text = "Waiting for image updates..."
+    self.onSelect()
+
+  def onTrackingStatus(self, tracker):
+    self.trackingStatusLabel.text = "{0:.1f} fps, {1} segmented, {2} dropped".format(
+      tracker.getFramesPerSecond(), tracker.framesSegmented, tracker.getFramesDropped())
+
+  def onSeedWatchToggled(self, enabled):
+    if not enabled:
+      self.logic.stopSeedWatching()
+      self.seedWatchStatusLabel.text = ""
+      self.onSelect()
+      return
+    self.updateLogicParameters()
+    self.logic.startSeedWatching(self.imageSelector.currentNode(), self.seedSelector.currentNode(),
+                                 self.outputSelector.currentNode(), self.manSegPointsSelector.currentNode(),
+                                 self.numToAddSliderWidget.value, self.enableNeedleModelsFlagCheckBox.checked,
+                                 statusCallback=self.onSeedWatchStatus)
+    self.seedWatchStatusLabel.text = "Waiting for seed changes..."
+    self.onSelect()
+
+  def onSeedWatchStatus(self, seedWatcher):
+    self.seedWatchStatusLabel.text = "{0} reused, {1} segmented".format(
+      seedWatcher.seedsReused, seedWatcher.seedsSegmented)
 
   def onApplyButton(self):
-    logic = StaticNeedleSegmentationLogic()
+    logic = self.logic
     enableScreenshotsFlag = self.enableScreenshotsFlagCheckBox.checked
     enableNeedleModelsFlag = self.enableNeedleModelsFlagCheckBox.checked
-    logic.run(self.imageSelector.currentNode(), self.seedSelector.currentNode(),
-              self.outputSelector.currentNode(), self.manSegPointsSelector.currentNode(),
-              self.numToAddSliderWidget.value, enableNeedleModelsFlag, enableScreenshotsFlag, )
+    self.updateLogicParameters()
+    try:
+      logic.runAsync(self.imageSelector.currentNode(), self.seedSelector.currentNode(),
+                     self.outputSelector.currentNode(), self.manSegPointsSelector.currentNode(),
+                     self.numToAddSliderWidget.value, enableNeedleModelsFlag, enableScreenshotsFlag,
+                     enableRoi=self.enableRoiFlagCheckBox.checked, multiSeed=self.enableMultiSeedFlagCheckBox.checked,
+                     pyramid=self.enablePyramidFlagCheckBox.checked,
+                     progressCallback=self.onRunProgress, finishedCallback=self.onRunFinished)
+    except Exception as e:
+      slicer.util.errorDisplay('Needle segmentation failed: ' + str(e))
+      return
+    self.progressBar.visible = True
+    self.cancelButton.visible = True
+    self.cancelButton.enabled = True
+    self.onSelect()
+
+  def onScratchDirectoryChanged(self, path):
+    self.logic.setScratchRoot(path if path else None)
+
+  def onCancelButton(self):
+    self.cancelButton.enabled = False
+    self.logic.cancelRun()
+
+  def onRunProgress(self, stage, percent):
+    self.progressBar.value = percent
+    self.progressBar.format = {'export': 'Exporting image...', 'segment': 'Segmenting needle...',
+                               'import': 'Importing results...'}.get(stage, '%p%')
+
+  def onRunFinished(self, success, errorMessage):
+    self.progressBar.visible = False
+    self.cancelButton.visible = False
+    self.onSelect()
+    if not success and not self.logic.cancelRequested:
+      slicer.util.errorDisplay('Needle segmentation failed: ' + errorMessage)
+
+#
+# StaticNeedleSegmentationResult
+#
+
+class StaticNeedleSegmentationResult(object):
+  """Needle found for one seed: tip and tail, optionally the centreline sampled from tail to tip (Nx3),
+  a confidence between 0 and 1 and the durations (seconds) of the internal stages of the algorithm.
+
+  Segmentation programs report it on a line of its own, "NEEDLE_RESULT <JSON object>", with
+  "tip", "tail" and optional "centerline", "confidence" and "timings" keys, for example:
+  NEEDLE_RESULT {"tip": [1.5, 20.0, 3.0], "tail": [1.0, 80.5, 2.0], "confidence": 0.92, "timings": {"filter": 0.4}}
+  """
+
+  messagePrefix = 'NEEDLE_RESULT'
+
+  def __init__(self, tip, tail, centerline=None, confidence=None, timings=None):
+    self.tip = [float(c) for c in tip[:3]]
+    self.tail = [float(c) for c in tail[:3]]
+    self.centerline = numpy.array(centerline, dtype=float).reshape(-1, 3).tolist() if centerline is not None and len(centerline) else None
+    self.confidence = float(confidence) if confidence is not None else None
+    self.timings = collections.OrderedDict(timings or {})
+
+  @classmethod
+  def fromMessage(cls, line):
+    """Parses a NEEDLE_RESULT line. Raises ValueError if it is malformed.
+    """
+    try:
+      values = json.loads(line.strip()[len(cls.messagePrefix):], object_pairs_hook=collections.OrderedDict)
+      if len(values['tip']) != 3 or len(values['tail']) != 3:
+        raise ValueError('tip and tail must have 3 coordinates')
+      return cls(values['tip'], values['tail'], values.get('centerline'), values.get('confidence'), values.get('timings'))
+    except (KeyError, TypeError, IndexError, ValueError) as e:
+      raise ValueError('Malformed segmentation result "' + line.strip() + '": ' + str(e))
+
+  def toMessage(self):
+    values = collections.OrderedDict([('tip', self.tip), ('tail', self.tail)])
+    if self.centerline is not None:
+      values['centerline'] = self.centerline
+    if self.confidence is not None:
+      values['confidence'] = self.confidence
+    if self.timings:
+      values['timings'] = self.timings
+    return self.messagePrefix + ' ' + json.dumps(values)
+
+  def mapPoints(self, mapFunction):
+    """Returns a copy with all points mapped by mapFunction (Nx3 array to Nx3 array) in one call
+    """
+    centerline = self.centerline or []
+    points = mapFunction(numpy.array([self.tip, self.tail] + centerline, dtype=float)).tolist()
+    return StaticNeedleSegmentationResult(points[0], points[1], points[2:] if centerline else None, self.confidence, self.timings)
+
+
+class StaticNeedleSegmentationResultParser(object):
+  """Incremental parser of the output of a segmentation program, which may arrive in chunks.
+
+  NEEDLE_RESULT lines are read as StaticNeedleSegmentationResult. Lines starting with ERROR
+  are collected in errors, other lines that are not numbers are taken as log messages.
+  Output without any NEEDLE_RESULT line is read in the legacy format: lines of 3 or 6 numbers,
+  six numbers per result (tip then tail), so the tip and tail may be on separate lines.
+  Lines with another count of numbers are taken as log messages.
+  """
+
+  def __init__(self):
+    self.buffer = ''
+    self.results = []
+    self.legacyValues = []
+    self.errors = []
+
+  def feed(self, text):
+    """Parses the complete lines of text, keeping an incomplete last line for the next call.
+    Returns the number of results found so far.
+    """
+    self.buffer += text
+    while '\n' in self.buffer:
+      line, self.buffer = self.buffer.split('\n', 1)
+      self.parseLine(line)
+    return len(self.results) + len(self.legacyValues) // 6
+
+  def parseLine(self, line):
+    line = line.strip()
+    if not line:
+      return
+    if line.startswith(StaticNeedleSegmentationResult.messagePrefix):
+      self.results.append(StaticNeedleSegmentationResult.fromMessage(line))
+      return
+    if line.startswith('ERROR'):
+      self.errors.append(line)
+      return
+    try:
+      values = [float(value) for value in line.split()]
+    except ValueError:
+      values = []
+    if len(values) in (3, 6):
+      self.legacyValues.extend(values)
+    else:
+      logging.debug('Segmentation output: ' + line)
+
+  def close(self):
+    """Parses the remaining output and returns the list of results.
+    Raises ValueError if legacy output ends with a tip without its tail.
+    """
+    self.parseLine(self.buffer)
+    self.buffer = ''
+    if self.results:
+      return self.results
+    if len(self.legacyValues) % 6:
+      raise ValueError('Incomplete segmentation result: ' + ' '.join(str(value) for value in self.legacyValues))
+    return [StaticNeedleSegmentationResult(self.legacyValues[first:first + 3], self.legacyValues[first + 3:first + 6])
+            for first in range(0, len(self.legacyValues), 6)]
+
+class StaticNeedleSegmentationError(RuntimeError):
+  """Error reported by the segmentation algorithm itself (an ERROR line or unreadable output),
+  as opposed to a failure of the process running it
+  """
+
+#
+# StaticNeedleSegmentationWorker
+#
+
+class StaticNeedleSegmentationWorker(object):
+  """Long-lived segmentation process, so that process startup and algorithm
+  initialisation are paid once instead of on every run.
+
+  The executable is started with the --worker argument. It must print a line
+  containing READY once initialised, then for every request line
+  "<image path> <seed x> <seed y> <seed z>" read from stdin print its result like a
+  one-shot call (see StaticNeedleSegmentationResultParser), or a line starting with ERROR.
+  Log lines may precede the result. The image path is everything before the last three
+  values, so it may contain spaces. An empty line asks it to exit.
+  """
+
+  workerArgument = '--worker'
+  readyMessage = 'READY'
+
+  def __init__(self, executableCommand, startupTimeout=30.0):
+    self.executableCommand = list(executableCommand)
+    self.startupTimeout = startupTimeout
+    self.process = None
+
+  def start(self):
+    """Launches the process and waits for its READY message.
+    Returns False if the executable does not support worker mode.
+    """
+    try:
+      self.process = subprocess.Popen(self.executableCommand + [self.workerArgument],
+                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                      universal_newlines=True, bufsize=1)
+    except OSError as e:
+      logging.debug('StaticNeedleSegmentationWorker: failed to start ' + ' '.join(self.executableCommand) + ': ' + str(e))
+      self.process = None
+      return False
+
+    # An executable without worker support may treat the argument as an image path and hang or exit,
+    # so give up on it if it is not ready in time
+    timer = threading.Timer(self.startupTimeout, self.process.kill)
+    timer.start()
+    try:
+      firstLine = self.process.stdout.readline()
+    finally:
+      timer.cancel()
+    if firstLine.strip() != self.readyMessage:
+      logging.debug('StaticNeedleSegmentationWorker: no worker support, got "' + firstLine.strip() + '"')
+      self.stop()
+      return False
+    return True
+
+  def isRunning(self):
+    return self.process is not None and self.process.poll() is None
+
+  def resetPeakMemory(self):
+    """Resets the peak resident memory of the process, so that getPeakMemory measures from now on (Linux only)
+    """
+    try:
+      with open('/proc/{0}/clear_refs'.format(self.process.pid), 'w') as clearRefsFile:
+        clearRefsFile.write('5')
+    except (IOError, OSError, AttributeError):
+      pass
+
+  def getPeakMemory(self):
+    """Returns the peak resident memory (bytes) of the process since it started or resetPeakMemory
+    was called, read from /proc (Linux only), or None if it is not available
+    """
+    try:
+      with open('/proc/{0}/status'.format(self.process.pid)) as statusFile:
+        for line in statusFile:
+          if line.startswith('VmHWM:'):
+            return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError, AttributeError):
+      pass
+    return None
+
+  def segment(self, imagePath, seedPoint):
+    """Sends one segmentation request and returns the output lines read up to its result.
+    Raises StaticNeedleSegmentationError if the algorithm reported an error,
+    RuntimeError if the process died.
+    """
+    if not self.isRunning():
+      raise RuntimeError('Segmentation worker is not running')
+    request = "{0} {1:.10} {2:.10} {3:.10}\n".format(imagePath, seedPoint[0], seedPoint[1], seedPoint[2])
+    parser = StaticNeedleSegmentationResultParser()
+    outputLines = []
+    try:
+      self.process.stdin.write(request)
+      self.process.stdin.flush()
+      # read log lines until the result, which may span several lines
+      while True:
+        outputLine = self.process.stdout.readline()
+        if not outputLine:
+          self.stop()
+          raise RuntimeError('Segmentation worker exited unexpectedly')
+        outputLines.append(outputLine)
+        if parser.feed(outputLine) or parser.errors:
+          break
+    except (IOError, OSError) as e:
+      self.stop()
+      raise RuntimeError('Segmentation worker failed: ' + str(e))
+    except ValueError as e:
+      raise StaticNeedleSegmentationError(str(e))
+    if parser.errors:
+      raise StaticNeedleSegmentationError('Segmentation worker reported: ' + parser.errors[0])
+    return ''.join(outputLines)
+
+  def stop(self):
+    if self.process is None:
+      return
+    if self.process.poll() is None:
+      try:
+        self.process.stdin.write('\n')
+        self.process.stdin.flush()
+      except (IOError, OSError):
+        pass
+      timer = threading.Timer(5.0, self.process.kill)
+      timer.start()
+      self.process.wait()
+      timer.cancel()
+    self.process = None
+
+#
+# StaticNeedleSegmentationBackend
+#
+
+class StaticNeedleSegmentationBackend(object):
+  """Segmentation algorithm used by StaticNeedleSegmentationLogic, selected by name for each run.
+
+  If exportsImage is set, the logic writes the image to segmentationRun.imagePath before segment is called.
+  prepare is called on the main thread and may read the scene; segment is called for each seed of
+  the run (segmentationRun.seedPoints), possibly from several worker threads at a time, and must only
+  use the state stored in segmentationRun by prepare. segment returns the output of the algorithm,
+  in the physical coordinates of the exported image, like the segmentation executable: a
+  NEEDLE_RESULT line (see StaticNeedleSegmentationResult) or "<tip x> <tip y> <tip z> <tail x> <tail y> <tail z>".
+  """
+
+  name = None
+  description = ''
+  exportsImage = False
+
+  def prepare(self, logic, segmentationRun, inputVolume):
+    pass
+
+  def segment(self, logic, segmentationRun, seedPoint):
+    raise NotImplementedError()
+
+  def getBuild(self, logic):
+    """Returns a string identifying the version of the algorithm, recorded with its metrics
+    """
+    return ''
+
+  def formatResult(self, tip, tail, centerline=None, confidence=None, timings=None):
+    return StaticNeedleSegmentationResult(tip, tail, centerline, confidence, timings).toMessage()
+
+
+class StaticNeedleSegmentationExecutableBackend(StaticNeedleSegmentationBackend):
+  """Calls the StaticNeedleTestBed executable (logic.executablePath) on the exported image
+  """
+
+  name = 'executable'
+  description = 'the StaticNeedleTestBed executable'
+  exportsImage = True
+
+  def segment(self, logic, segmentationRun, seedPoint):
+    return logic.segmentWithExecutable(segmentationRun.imagePath, seedPoint, segmentationRun.useWorker)
+
+  def getBuild(self, logic):
+    return logic.getExecutableBuild()
+
+
+class StaticNeedleSegmentationNumpyBackend(StaticNeedleSegmentationBackend):
+  """Segments the needle in the Slicer process, without writing files or starting processes.
+
+  Voxels brighter than thresholdFraction of the intensity range within searchRadius of the seed
+  are candidate needle points. Lines through pairs of candidates are drawn at random (RANSAC),
+  starting near the seed; lines passing further than seedDistance from the seed or deviating more
+  than angleTolerance from the expected insertion angle are rejected. The line with the most
+  candidates within inlierDistance is refined by a least-squares fit to those candidates, which
+  must also be within angleTolerance of the expected insertion angle.
+  """
+
+  name = 'numpy'
+  description = 'a line fit computed in Slicer, without files or processes'
+
+  def __init__(self):
+    self.searchRadius = 100.0  # mm
+    self.thresholdFraction = 0.6
+    self.inlierDistance = 1.5  # mm
+    self.seedDistance = 5.0  # mm
+    self.angleTolerance = 15.0  # degrees
+    self.numberOfHypotheses = 256
+    self.maximumNumberOfSamples = 20000  # candidates used to score the lines
+
+  def prepare(self, logic, segmentationRun, inputVolume):
+    """Copies the voxels around the seeds, so that the volume may change while segment runs
+    """
+    extent = segmentationRun.roiExtent
+    if extent is None:
+      extent = logic.computePointsRoiExtent(inputVolume, segmentationRun.seedPoints, self.searchRadius)
+    if extent is None:
+      extent = inputVolume.GetImageData().GetExtent()
+    voxels = slicer.util.arrayFromVolume(inputVolume)
+    if voxels.ndim == 4:
+      voxels = voxels[..., 0]
+    segmentationRun.voxels = numpy.array(voxels[extent[4]:extent[5] + 1, extent[2]:extent[3] + 1, extent[0]:extent[1] + 1])
+    spacing = inputVolume.GetSpacing()
+    origin = inputVolume.GetOrigin()
+    segmentationRun.voxelSpacing = list(spacing)
+    segmentationRun.voxelOrigin = [origin[axis] + extent[2 * axis] * spacing[axis] for axis in range(3)]
+
+  def getBuild(self, logic):
+    return 'numpy ' + numpy.__version__
+
+  def segment(self, logic, segmentationRun, seedPoint):
+    timings = collections.OrderedDict()
+    startTime = time.time()
+    voxels = segmentationRun.voxels
+    seedPoint = numpy.array(seedPoint, dtype=float)
+    minimum = float(voxels.min())
+    threshold = minimum + self.thresholdFraction * (float(voxels.max()) - minimum)
+    k, j, i = numpy.nonzero(voxels > threshold)
+    points = numpy.column_stack((i, j, k)) * segmentationRun.voxelSpacing + segmentationRun.voxelOrigin
+    points = points[numpy.linalg.norm(points - seedPoint, axis=1) < self.searchRadius]
+    if len(points) < 2:
+      raise ValueError('No needle found near the seed point')
+
+    timings['threshold'] = time.time() - startTime
+    startTime = time.time()
+    randomState = numpy.random.RandomState(0)  # reproducible results
+    samples = points
+    if len(samples) > self.maximumNumberOfSamples:
+      samples = samples[randomState.choice(len(samples), self.maximumNumberOfSamples, replace=False)]
+    anchors = samples[numpy.linalg.norm(samples - seedPoint, axis=1) <= self.seedDistance]
+    if len(anchors) == 0:
+      anchors = samples
+
+    # candidate lines from a point near the seed through another candidate
+    starts = anchors[randomState.randint(len(anchors), size=self.numberOfHypotheses)]
+    directions = samples[randomState.randint(len(samples), size=self.numberOfHypotheses)] - starts
+    lengths = numpy.linalg.norm(directions, axis=1)
+    valid = lengths > 0
+    directions[valid] /= lengths[valid, numpy.newaxis]
+    toSeed = seedPoint - starts
+    seedDistances = numpy.linalg.norm(toSeed - numpy.einsum('ij,ij->i', toSeed, directions)[:, numpy.newaxis] * directions, axis=1)
+    valid &= seedDistances <= self.seedDistance
+    # A-P axis in the coordinates of the image, the insertion angle is measured from it
+    apAxis = segmentationRun.imageDirections[:3, 1]
+    if segmentationRun.insertAngle is not None:
+      expectedAngle = min(segmentationRun.insertAngle % 180.0, 180.0 - segmentationRun.insertAngle % 180.0)
+      angles = numpy.degrees(numpy.arccos(numpy.clip(numpy.abs(directions.dot(apAxis)), 0.0, 1.0)))
+      valid &= numpy.abs(angles - expectedAngle) <= self.angleTolerance
+    hypotheses = numpy.nonzero(valid)[0]
+    if len(hypotheses) == 0:
+      raise ValueError('No needle found near the seed point at the expected insertion angle')
+
+    # score the candidate lines a few at a time to bound memory use
+    bestLine = None
+    bestCount = -1
+    for first in range(0, len(hypotheses), 16):
+      chunk = hypotheses[first:first + 16]
+      offsets = samples[numpy.newaxis, :, :] - starts[chunk, numpy.newaxis, :]
+      along = numpy.einsum('hnc,hc->hn', offsets, directions[chunk])
+      counts = ((offsets ** 2).sum(axis=2) - along ** 2 <= self.inlierDistance ** 2).sum(axis=1)
+      if counts.max() > bestCount:
+        bestCount = counts.max()
+        bestLine = chunk[counts.argmax()]
+
+    timings['ransac'] = time.time() - startTime
+    startTime = time.time()
+
+    # least-squares line through all the candidates close to the best line
+    offsets = points - starts[bestLine]
+    along = offsets.dot(directions[bestLine])
+    inliers = points[(offsets ** 2).sum(axis=1) - along ** 2 <= self.inlierDistance ** 2]
+    center = inliers.mean(axis=0)
+    direction = numpy.linalg.svd(inliers - center, full_matrices=False)[2][0]
+    if segmentationRun.insertAngle is not None:
+      # lines between neighbouring voxels may pass the angle test whatever the needle direction
+      angle = numpy.degrees(numpy.arccos(numpy.clip(abs(direction.dot(apAxis)), 0.0, 1.0)))
+      if abs(angle - expectedAngle) > self.angleTolerance:
+        raise ValueError('No needle found near the seed point at the expected insertion angle')
+    # the tip is the end the needle points to, needles are inserted along -A (see computeMetricsArray)
+    if direction.dot(apAxis) > 0:
+      direction = -direction
+    projections = (inliers - center).dot(direction)
+    timings['fit'] = time.time() - startTime
+    # confidence: fraction of the bright voxels around the seed that lie on the needle
+    return self.formatResult(center + projections.max() * direction, center + projections.min() * direction,
+                             confidence=float(len(inliers)) / len(points), timings=timings)
+
+#
+# StaticNeedleSegmentationVolumeTransform
+#
+
+class StaticNeedleSegmentationVolumeTransform(object):
+  """Maps points between RAS and the physical coordinates of the exported image of a volume,
+  which are the local coordinates of the volume with its IJK to RAS directions applied.
+
+  The parent transforms and the direction matrix are composed into NumPy 4x4 matrices when first
+  needed and again only after the volume or one of its transforms is modified, so that any number
+  of points is mapped with one matrix product. Non-linear parent transforms are applied through VTK.
+  """
+
+  def __init__(self, volumeNode):
+    self.volumeNode = volumeNode
+    self.observerTags = [volumeNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.invalidate),
+                         volumeNode.AddObserver(slicer.vtkMRMLTransformableNode.TransformModifiedEvent, self.invalidate)]
+    self.invalidate()
+
+  def release(self):
+    for observerTag in self.observerTags:
+      self.volumeNode.RemoveObserver(observerTag)
+    self.observerTags = []
+
+  def invalidate(self, caller=None, event=None):
+    self.directions = None  # IJK to RAS directions (4x4), from local to image coordinates
+    self.worldToImageMatrix = None  # None if the parent transform is not linear
+    self.imageToWorldMatrix = None
+    self.worldToLocalTransform = None  # vtkGeneralTransform, if the parent transform is not linear
+    self.localToWorldTransform = None
+    self.cacheKey = None
+
+  def update(self):
+    if self.directions is not None:
+      return
+    ijkToRasDirs = vtk.vtkMatrix4x4()
+    self.volumeNode.GetIJKToRASDirectionMatrix(ijkToRasDirs)
+    self.directions = self.arrayFromMatrix(ijkToRasDirs)
+    transformNode = self.volumeNode.GetParentTransformNode()
+    if transformNode is None:
+      worldToLocal = numpy.eye(4)
+      self.cacheKey = None
+    elif transformNode.IsTransformToWorldLinear():
+      worldToLocalMatrix = vtk.vtkMatrix4x4()
+      transformNode.GetMatrixTransformFromWorld(worldToLocalMatrix)
+      worldToLocal = self.arrayFromMatrix(worldToLocalMatrix)
+      self.cacheKey = tuple(numpy.round(worldToLocal, 6).flatten())
+    else:
+      worldToLocal = None
+      self.worldToLocalTransform = vtk.vtkGeneralTransform()
+      transformNode.GetTransformFromWorld(self.worldToLocalTransform)
+      self.localToWorldTransform = vtk.vtkGeneralTransform()
+      transformNode.GetTransformToWorld(self.localToWorldTransform)
+      # identify the transform by where it maps the corners of the volume
+      bounds = [0.0] * 6
+      self.volumeNode.GetRASBounds(bounds)
+      corners = numpy.array([[x, y, z] for x in bounds[0:2] for y in bounds[2:4] for z in bounds[4:6]])
+      self.cacheKey = tuple(numpy.round(self.applyTransform(self.worldToLocalTransform, corners), 6).flatten())
+    if worldToLocal is not None:
+      self.worldToImageMatrix = self.directions.dot(worldToLocal)
+      self.imageToWorldMatrix = numpy.linalg.inv(self.worldToImageMatrix)
+
+  def getDirections(self):
+    """Returns a copy of the IJK to RAS direction matrix, as a 4x4 array
+    """
+    self.update()
+    return self.directions.copy()
+
+  def getCacheKey(self):
+    """Returns a value that changes when the parent transforms change
+    """
+    self.update()
+    return self.cacheKey
+
+  def worldToImage(self, points):
+    """Maps RAS points (Nx3 array) to image coordinates
+    """
+    self.update()
+    points = numpy.asarray(points, dtype=float).reshape(-1, 3)
+    if self.worldToImageMatrix is not None:
+      return self.applyMatrix(self.worldToImageMatrix, points)
+    return self.applyMatrix(self.directions, self.applyTransform(self.worldToLocalTransform, points))
+
+  def imageToWorld(self, points):
+    """Maps image coordinates (Nx3 array) to RAS
+    """
+    self.update()
+    points = numpy.asarray(points, dtype=float).reshape(-1, 3)
+    if self.imageToWorldMatrix is not None:
+      return self.applyMatrix(self.imageToWorldMatrix, points)
+    localPoints = self.applyMatrix(numpy.linalg.inv(self.directions), points)
+    return self.applyTransform(self.localToWorldTransform, localPoints)
+
+  @staticmethod
+  def arrayFromMatrix(matrix):
+    return numpy.array([[matrix.GetElement(i, j) for j in range(4)] for i in range(4)])
+
+  @staticmethod
+  def applyMatrix(matrix, points):
+    return points.dot(matrix[:3, :3].T) + matrix[:3, 3]
+
+  @staticmethod
+  def applyTransform(transform, points):
+    inputPoints = vtk.vtkPoints()
+    inputPoints.SetData(numpy_support.numpy_to_vtk(numpy.ascontiguousarray(points), deep=True))
+    outputPoints = vtk.vtkPoints()
+    transform.TransformPoints(inputPoints, outputPoints)
+    return numpy_support.vtk_to_numpy(outputPoints.GetData()).astype(float)
+
+#
+# StaticNeedleSegmentationRun
+#
+
+class StaticNeedleSegmentationRun(object):
+  """State of one segmentation, handed from stage to stage of
+  StaticNeedleSegmentationLogic.run and runAsync
+  """
+
+  def __init__(self):
+    self.stage = None
+    self.reportedStage = None
+    self.workingDirectory = None  # temporary directory of this run, removed when the run is released
+    self.imagePath = None
+    self.pendingExport = None  # image snapshot still to be written, None if the file on disk is up to date
+    self.roiExtent = None  # voxel extent of the exported region, None if the whole volume is exported
+    self.volumeBounds = None  # RAS bounds of the volume, the needle models extend to them
+    self.pyramidSource = None  # full resolution volume refined after a downsampled pass, in pyramid mode
+    self.seedPoint = None  # seed in the coordinate system of the exported image
+    self.seedPoints = None  # all seeds of a multi-seed run (only seedPoint otherwise), same coordinate system
+    self.rasSeedPoints = None  # seedPoints in RAS coordinates
+    self.multiSeed = False
+    self.useWorker = True  # False when several runs execute concurrently
+    self.volumeTransform = None  # StaticNeedleSegmentationVolumeTransform of the segmented volume
+    self.imageDirections = None  # IJK to RAS directions (4x4 array) of the exported image
+    self.backend = None  # StaticNeedleSegmentationBackend segmenting this run
+    self.insertAngle = None
+    self.voxels = None  # copy of the voxels segmented by backends that do not export the image
+    self.voxelSpacing = None
+    self.voxelOrigin = None
+    self.outputFromExe = None
+    self.resultCacheKey = None  # None if the result is not to be cached
+    self.diskCacheSource = None  # volume hashed in executeRun to look up the disk cache, if the memory cache missed
+    self.diskCacheKey = None
+    self.cancelled = False
+    self.error = None
+    self.thread = None
+    self.progressCallback = None
+    self.finishedCallback = None
+    self.finishArguments = ()
+    self.report = StaticNeedleSegmentationRunReport()
+
+#
+# StaticNeedleSegmentationTracker
+#
+
+class StaticNeedleSegmentationTracker(object):
+  """Re-segments a volume every time its image data is modified, for volumes that are
+  continuously updated (e.g. received through OpenIGTLink).
+
+  Updates arriving within debounceInterval milliseconds of each other, or while a segmentation
+  is running, are coalesced: only the newest image is segmented and the others are counted
+  as dropped. Each segmentation is seeded with the midpoint of the previous tip and tail,
+  or with the seed fiducial when there is no previous result.
+  Frames are never looked up in the result cache, and their voxels are copied before being written.
+  """
+
+  def __init__(self, logic, inputVolume, inputSeedFiducial, outputPoints, insertAngle, enableRoi=False,
+               statusCallback=None, debounceInterval=50):
+    self.logic = logic
+    self.inputVolume = inputVolume
+    self.inputSeedFiducial = inputSeedFiducial
+    self.outputPoints = outputPoints
+    self.insertAngle = insertAngle
+    self.enableRoi = enableRoi
+    self.statusCallback = statusCallback  # called with the tracker after every segmentation
+    self.active = False
+    self.observerTag = None
+    self.framePending = False
+    self.previousSeed = None
+    self.framesReceived = 0
+    self.framesSegmented = 0
+    self.framesFailed = 0
+    self.completionTimes = collections.deque(maxlen=20)
+    self.debounceTimer = qt.QTimer()
+    self.debounceTimer.setSingleShot(True)
+    self.debounceTimer.setInterval(debounceInterval)
+    self.debounceTimer.connect('timeout()', self.segmentLatestFrame)
+
+  def start(self):
+    self.active = True
+    self.observerTag = self.inputVolume.AddObserver(slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent, self.onImageDataModified)
+    self.onImageDataModified()  # segment the current image
+
+  def stop(self):
+    self.active = False
+    self.debounceTimer.stop()
+    if self.observerTag is not None:
+      self.inputVolume.RemoveObserver(self.observerTag)
+      self.observerTag = None
+
+  def onImageDataModified(self, caller=None, event=None):
+    self.framesReceived += 1
+    self.debounceTimer.start()  # restarted by every update, so bursts are coalesced
+
+  def segmentLatestFrame(self):
+    if not self.active:
+      return
+    if self.logic.isRunning():
+      # segmented when the running segmentation completes
+      self.framePending = True
+      return
+    self.framePending = False
+    seed = self.previousSeed if self.previousSeed is not None else self.inputSeedFiducial
+    self.framesSegmented += 1
+    try:
+      self.logic.runAsync(self.inputVolume, seed, self.outputPoints, None, self.insertAngle, False,
+                          enableRoi=self.enableRoi, finishedCallback=self.onSegmentationFinished, liveVolume=True)
+    except Exception as e:
+      self.onSegmentationFinished(False, str(e))
+
+  def onSegmentationFinished(self, success, errorMessage):
+    if success and self.outputPoints.GetNumberOfFiducials() >= 2:
+      tip = [0.0, 0.0, 0.0]
+      tail = [0.0, 0.0, 0.0]
+      self.outputPoints.GetNthFiducialPosition(0, tip)
+      self.outputPoints.GetNthFiducialPosition(1, tail)
+      self.previousSeed = [(a + b) / 2.0 for a, b in zip(tip, tail)]
+      self.completionTimes.append(time.time())
+    else:
+      logging.warning('Tracking segmentation failed: ' + str(errorMessage))
+      self.framesFailed += 1
+      self.previousSeed = None
+    if self.statusCallback is not None:
+      self.statusCallback(self)
+    if self.active and self.framePending:
+      self.segmentLatestFrame()
+
+  def getFramesPerSecond(self):
+    """Returns the rate of completed segmentations over the last few frames
+    """
+    if len(self.completionTimes) < 2:
+      return 0.0
+    elapsed = self.completionTimes[-1] - self.completionTimes[0]
+    return (len(self.completionTimes) - 1) / elapsed if elapsed > 0 else 0.0
+
+  def getFramesDropped(self):
+    """Returns the number of image updates that were superseded before being segmented
+    """
+    return max(self.framesReceived - self.framesSegmented - (1 if self.framePending else 0), 0)
+
+#
+# StaticNeedleSegmentationSeedWatcher
+#
+
+class StaticNeedleSegmentationSeedWatcher(object):
+  """Updates the segmentation of a volume when its seed fiducial is moved.
+
+  A seed within the logic's reseedTolerance of the current tip-tail segment is considered
+  to be on the same needle: the result is kept and the executable is not called.
+  Other seeds are segmented again, exporting only a region around the current needle
+  and the new seed (reseedMargin on every side). Moves arriving within debounceInterval
+  milliseconds of each other, or while a segmentation is running, are coalesced.
+  """
+
+  def __init__(self, logic, inputVolume, inputSeedFiducial, outputPoints, manSegPoints, insertAngle,
+               enableNeedleModels=False, statusCallback=None, debounceInterval=200):
+    self.logic = logic
+    self.inputVolume = inputVolume
+    self.inputSeedFiducial = inputSeedFiducial
+    self.outputPoints = outputPoints
+    self.manSegPoints = manSegPoints
+    self.insertAngle = insertAngle
+    self.enableNeedleModels = enableNeedleModels
+    self.statusCallback = statusCallback  # called with the watcher after every seed change
+    self.active = False
+    self.observerTag = None
+    self.seedPending = False
+    self.seedsReused = 0
+    self.seedsSegmented = 0
+    self.seedsFailed = 0
+    self.debounceTimer = qt.QTimer()
+    self.debounceTimer.setSingleShot(True)
+    self.debounceTimer.setInterval(debounceInterval)
+    self.debounceTimer.connect('timeout()', self.updateSegmentation)
+
+  def start(self):
+    self.active = True
+    self.observerTag = self.inputSeedFiducial.AddObserver(slicer.vtkMRMLMarkupsNode.PointModifiedEvent, self.onSeedModified)
+
+  def stop(self):
+    self.active = False
+    self.debounceTimer.stop()
+    if self.observerTag is not None:
+      self.inputSeedFiducial.RemoveObserver(self.observerTag)
+      self.observerTag = None
+
+  def onSeedModified(self, caller=None, event=None):
+    self.debounceTimer.start()  # restarted by every move, so dragging the seed is coalesced
+
+  def getCurrentNeedle(self):
+    """Returns the current tip and tail (RAS), or None if there is no result yet
+    """
+    if self.outputPoints.GetNumberOfFiducials() < 2:
+      return None
+    tip = [0.0, 0.0, 0.0]
+    tail = [0.0, 0.0, 0.0]
+    self.outputPoints.GetNthFiducialPosition(0, tip)
+    self.outputPoints.GetNthFiducialPosition(1, tail)
+    return tip, tail
+
+  def updateSegmentation(self):
+    if not self.active or self.inputSeedFiducial.GetNumberOfFiducials() == 0:
+      return
+    if self.logic.isRunning():
+      # updated when the running segmentation completes
+      self.seedPending = True
+      return
+    self.seedPending = False
+    seedPoint = self.logic.getSeedPoint(self.inputSeedFiducial)
+    needle = self.getCurrentNeedle()
+    roiPoints = None
+    if needle is not None:
+      if self.logic.distanceToSegment(seedPoint, needle[0], needle[1]) <= self.logic.reseedTolerance:
+        logging.debug('Seed is on the segmented needle, keeping the result')
+        self.seedsReused += 1
+        if self.statusCallback is not None:
+          self.statusCallback(self)
+        return
+      roiPoints = [needle[0], needle[1], seedPoint]
+    self.seedsSegmented += 1
+    try:
+      self.logic.runAsync(self.inputVolume, seedPoint, self.outputPoints, self.manSegPoints, self.insertAngle,
+                          self.enableNeedleModels, roiPoints=roiPoints, finishedCallback=self.onSegmentationFinished)
+    except Exception as e:
+      self.onSegmentationFinished(False, str(e))
+
+  def onSegmentationFinished(self, success, errorMessage):
+    if not success:
+      logging.warning('Seed update segmentation failed: ' + str(errorMessage))
+      self.seedsFailed += 1
+    if self.statusCallback is not None:
+      self.statusCallback(self)
+    if self.active and self.seedPending:
+      self.updateSegmentation()
+
+def openCsvFile(fileName, mode='r'):
+  """Opens a file for the csv module, which handles line endings itself: without this,
+  rows written on Windows are followed by blank lines
+  """
+  if sys.version_info[0] < 3:
+    return open(fileName, mode + 'b')
+  return open(fileName, mode, newline='')
+
+#
+# StaticNeedleSegmentationMetricsSink
+#
+
+class StaticNeedleSegmentationMetricsSink(object):
+  """Collects the metrics of segmentations together with the volume, seed and algorithm build they come from.
+
+  append buffers rows; flush writes them to the Metrics table in a single update and, if fileName is set,
+  appends them to that CSV file and syncs it to disk, so that the rows of a long session survive a crash.
+  Rows are flushed automatically once maximumBufferedRows are buffered. The table node is kept
+  rather than looked up by name, and recreated if it is removed from the scene.
+  """
+
+  tableName = 'Metrics'
+  metadataColumnNames = ['Volume', 'Seed R', 'Seed A', 'Seed S', 'Backend', 'Build', 'Timestamp']
+  textColumnNames = ['Volume', 'Backend', 'Build']
+
+  def __init__(self, metricsColumnNames):
+    self.metricsColumnNames = list(metricsColumnNames)
+    self.columnNames = self.metricsColumnNames + self.metadataColumnNames
+    self.tableNode = None
+    self.fileName = None
+    self.maximumBufferedRows = 64
+    self.metricsBuffer = []  # arrays of metrics rows
+    self.metadataBuffer = []  # metadataColumnNames values of each buffered row
+
+  def getTableNode(self):
+    """Returns the Metrics table node, adopting the one of the scene or creating it if needed
+    """
+    if self.tableNode is None or self.tableNode.GetScene() is None:
+      tableNode = slicer.mrmlScene.GetFirstNodeByName(self.tableName)
+      if tableNode is None or not tableNode.IsA('vtkMRMLTableNode'):
+        tableNode = slicer.vtkMRMLTableNode()
+        tableNode.SetName(self.tableName)
+        slicer.mrmlScene.AddNode(tableNode)
+      self.tableNode = tableNode
+    return self.tableNode
+
+  def addMissingColumns(self, tableNode):
+    """Adds the columns a table created by an earlier version of the module lacks, empty in existing rows
+    """
+    table = tableNode.GetTable()
+    for columnName in self.columnNames:
+      if table.GetColumnByName(columnName) is not None:
+        continue
+      column = tableNode.AddColumn(vtk.vtkStringArray() if columnName in self.textColumnNames else vtk.vtkDoubleArray())
+      column.SetName(columnName)
+      if isinstance(column, vtk.vtkDoubleArray):
+        numpy_support.vtk_to_numpy(column)[:] = numpy.nan
+
+  def append(self, metrics, volumeName=None, seedPoints=None, backendName=None, build=None):
+    """Buffers rows of metrics (an Nx5 array as returned by computeMetricsArray).
+    seedPoints (RAS) holds one seed per row, or one seed for all rows.
+    """
+    metrics = numpy.asarray(metrics, dtype=float).reshape(-1, len(self.metricsColumnNames))
+    if seedPoints is None:
+      seedPoints = [[numpy.nan] * 3]
+    seedPoints = numpy.broadcast_to(numpy.asarray(seedPoints, dtype=float).reshape(-1, 3), (len(metrics), 3))
+    timestamp = time.time()
+    self.metricsBuffer.append(metrics)
+    for seedPoint in seedPoints:
+      self.metadataBuffer.append([volumeName or ''] + list(seedPoint) + [backendName or '', build or '', timestamp])
+    if len(self.metadataBuffer) >= self.maximumBufferedRows:
+      self.flush()
+
+  def flush(self, tableNode=None):
+    """Writes the buffered rows to tableNode, by default the Metrics table, and to fileName
+    """
+    if not self.metadataBuffer:
+      return
+    metrics = numpy.vstack(self.metricsBuffer)
+    metadata = self.metadataBuffer
+    self.metricsBuffer = []
+    self.metadataBuffer = []
+    self.writeTableRows(tableNode or self.getTableNode(), metrics, metadata)
+    if self.fileName:
+      self.writeFileRows(metrics, metadata)
+
+  def writeTableRows(self, tableNode, metrics, metadata):
+    self.addMissingColumns(tableNode)
+    table = tableNode.GetTable()
+    firstRow = table.GetNumberOfRows()
+    table.SetNumberOfRows(firstRow + len(metrics))
+    for columnIndex, columnName in enumerate(self.columnNames):
+      if columnIndex < len(self.metricsColumnNames):
+        values = metrics[:, columnIndex]
+      else:
+        values = [row[columnIndex - len(self.metricsColumnNames)] for row in metadata]
+      column = table.GetColumnByName(columnName)
+      if isinstance(column, vtk.vtkDoubleArray):
+        numpy_support.vtk_to_numpy(column)[firstRow:] = values
+      else:
+        # text column, also used for the metrics by tables created by earlier versions of the module
+        for row, value in enumerate(values):
+          column.SetValue(firstRow + row, value if columnName in self.textColumnNames else "{0:.10}".format(value))
+      column.Modified()
+    table.Modified()
+    tableNode.Modified()
+
+  def writeFileRows(self, metrics, metadata):
+    """Appends rows to the CSV file, writing the header first if the file is new
+    """
+    writeHeader = not os.path.exists(self.fileName) or os.path.getsize(self.fileName) == 0
+    with openCsvFile(self.fileName, 'a') as metricsFile:
+      writer = csv.writer(metricsFile)
+      if writeHeader:
+        writer.writerow(self.columnNames)
+      for metricsRow, metadataRow in zip(metrics, metadata):
+        writer.writerow(list(metricsRow) + metadataRow)
+      metricsFile.flush()
+      os.fsync(metricsFile.fileno())
+
+#
+# StaticNeedleSegmentationRunReport
+#
+
+class StaticNeedleSegmentationRunReport(object):
+  """Timings of the stages of one segmentation run, with the bytes written and peak memory use.
+
+  workerPeakRssBytes is the peak memory of the segmentation worker during this run. The other peaks
+  come from getrusage, which only knows lifetime peaks: slicerLifetimePeakRssBytes is the peak of the
+  Slicer process since it started, exitedChildPeakRssBytes the largest peak of the child processes that
+  have exited so far (one-shot executable calls, not the running worker).
+  """
+
+  def __init__(self):
+    self.timestamp = time.time()
+    self.stageSeconds = collections.OrderedDict()
+    self.totalSeconds = None
+    self.bytesWritten = 0
+    self.exportCacheHit = None
+    self.resultCacheHit = False
+    self.workerPeakRssBytes = None  # None if no worker segmented this run, or outside Linux
+    self.slicerLifetimePeakRssBytes = None
+    self.exitedChildPeakRssBytes = None
+    self.volumeName = None
+    self.executablePath = None
+    self.algorithmSeconds = collections.OrderedDict()  # internal stages reported by the algorithm, summed over the seeds
+    self.confidences = []  # reported by the algorithm, one per seed (None if not reported)
+    self.error = None
+
+  @contextlib.contextmanager
+  def timeStage(self, stageName):
+    """Context manager adding the duration of the enclosed block to stageName
+    """
+    startTime = time.time()
+    try:
+      yield
+    finally:
+      self.stageSeconds[stageName] = self.stageSeconds.get(stageName, 0.0) + time.time() - startTime
+
+  def finish(self):
+    self.totalSeconds = time.time() - self.timestamp
+    if resource is not None:
+      # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+      scale = 1 if sys.platform == 'darwin' else 1024
+      self.slicerLifetimePeakRssBytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+      self.exitedChildPeakRssBytes = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+
+  def toDict(self):
+    return collections.OrderedDict([
+      ('timestamp', self.timestamp), ('volume', self.volumeName), ('executable', self.executablePath),
+      ('totalSeconds', self.totalSeconds), ('stageSeconds', self.stageSeconds), ('bytesWritten', self.bytesWritten),
+      ('exportCacheHit', self.exportCacheHit), ('resultCacheHit', self.resultCacheHit),
+      ('workerPeakRssBytes', self.workerPeakRssBytes), ('slicerLifetimePeakRssBytes', self.slicerLifetimePeakRssBytes),
+      ('exitedChildPeakRssBytes', self.exitedChildPeakRssBytes),
+      ('algorithmSeconds', self.algorithmSeconds), ('confidences', self.confidences), ('error', self.error)])
+
+  def toJson(self):
+    return json.dumps(self.toDict())
+
+  def __str__(self):
+    stages = ', '.join('{0} {1:.3f} s'.format(name, seconds) for name, seconds in self.stageSeconds.items())
+    return 'Run report: {0:.3f} s total ({1}), {2} bytes written'.format(self.totalSeconds or 0.0, stages, self.bytesWritten)
 
 #
 # StaticNeedleSegmentationLogic
@@ -198,6 +1349,84 @@ class StaticNeedleSegmentationLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  def __init__(self, parent=None):
+    ScriptedLoadableModuleLogic.__init__(self, parent)
+    # Images already written to disk, keyed by volume node ID, so unchanged volumes are not re-exported
+    self.exportCache = {}
+    self.exportCacheHits = 0
+    self.exportCacheMisses = 0
+    self.exportCacheLock = threading.Lock()
+    # 'mha' writes through vtkMetaImageWriter from a copy of the volume, 'raw' writes an .mhd/.raw pair
+    # straight from the volume scalars. Size and duration of the last export are kept for profiling.
+    self.exportFormat = 'mha'
+    self.lastExportStatistics = None
+    # Temporary files are written below scratchRoot (e.g. a RAM disk such as /dev/shm),
+    # by default the system temporary directory
+    self.scratchRoot = os.environ.get('STATIC_NEEDLE_SEGMENTATION_SCRATCH') or None
+    self.scratchDirectory = None
+    # Report of the last run. If runReportFileName is set, every report is appended to it as a JSON line.
+    self.lastRunReport = None
+    # StaticNeedleSegmentationResult (RAS) of each seed of the last imported run
+    self.lastResults = []
+    self.runReportFileName = None
+    # Metrics of the runs compared to a manually selected tip. Set metricsSink.fileName to also stream them to a CSV file.
+    self.metricsSink = StaticNeedleSegmentationMetricsSink(self.metricsColumnNames)
+    self.executableBuilds = {}  # (path, modification time, size) -> build string of the executable
+    # Segmentation results of recent runs, keyed on volume content, seed, transform and parameters
+    self.enableResultCache = True
+    self.resultCacheSize = 32
+    self.resultCacheSeedTolerance = 0.1  # mm, seeds closer than this are treated as identical
+    self.resultCacheDirectory = None  # if set, results are also kept on disk there
+    self.resultCache = collections.OrderedDict()
+    self.resultCacheLock = threading.Lock()
+    self.resultCacheHits = 0
+    self.resultCacheMisses = 0
+    self.resultCacheDiskHits = 0
+    self.volumeHashes = {}  # content hashes identifying volumes in the disk cache, by node ID
+    # Segmentation executable, kept running between runs if it supports worker mode
+    self.executablePath = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'StaticNeedleTestBed')
+    self.executableLauncher = None  # program the executable is passed to, e.g. a Python interpreter for a script
+    self.useWorker = True
+    self.worker = None
+    self.workerSupported = None  # unknown until the first attempt to start the worker
+    # Segmentation algorithms, by name. backendName is used by runs that do not select one.
+    self.backends = collections.OrderedDict()
+    self.registerBackend(StaticNeedleSegmentationExecutableBackend())
+    self.registerBackend(StaticNeedleSegmentationNumpyBackend())
+    self.backendName = StaticNeedleSegmentationExecutableBackend.name
+    # Size of the region exported around the seed when the ROI mode is enabled:
+    # length (mm) along the expected needle direction and margin (mm) around that line
+    self.roiLength = 120.0
+    self.roiMargin = 10.0
+    # Pyramid mode: the image is first segmented after downsampling by pyramidShrinkFactor along each axis,
+    # then at full resolution in a region extending pyramidMargin (mm) around the coarse needles
+    self.pyramidShrinkFactor = 4
+    self.pyramidMargin = 10.0
+    # One-shot segmentation processes currently running (killed on cancel)
+    self.activeProcesses = set()
+    self.cancelRequested = False
+    # Asynchronous run in progress, if any
+    self.asyncRun = None
+    self.asyncRunTimer = None
+    # Re-segments the input volume whenever it is updated, if tracking is enabled
+    self.tracker = None
+    # StaticNeedleSegmentationVolumeTransform of each segmented volume, by node ID,
+    # released with the volume hash when the node is removed from the scene
+    self.volumeTransforms = {}
+    self.sceneObserverTag = None
+    # Needle model pipelines, updated in place by later runs: (output node ID, needle index) -> (model node ID, line source, tube filter)
+    self.needleModels = {}
+    self.needleModelRadius = 1.0  # mm
+    # Updates the segmentation when the seed is moved, if enabled. Seeds closer than reseedTolerance (mm)
+    # to the segmented needle keep the result, others are segmented in a region extending reseedMargin (mm)
+    # around the previous needle and the new seed.
+    self.seedWatcher = None
+    self.reseedTolerance = 2.0
+    self.reseedMargin = 15.0
+
+  # Progress (in percent) reported when each stage of a run starts
+  runStageProgress = {'export': 0, 'segment': 30, 'import': 90, 'done': 100}
+
   def hasImageData(self,volumeNode):
     """This is an example logic method that
     returns true if the passed in volume
@@ -225,6 +1454,493 @@ class StaticNeedleSegmentationLogic(ScriptedLoadableModuleLogic):
       return False
     return True
 
+  def getExportCacheKey(self, inputVolume, roiExtent=None):
+    """Returns a key that changes whenever the exported image file would change:
+    the image data modification time, the volume geometry and the exported region
+    """
+    imageData = inputVolume.GetImageData()
+    ijkToRasDirs = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASDirectionMatrix(ijkToRasDirs)
+    directions = tuple(ijkToRasDirs.GetElement(i, j) for i in range(3) for j in range(3))
+    roi = tuple(roiExtent) if roiExtent is not None else None
+    return (imageData.GetMTime(), tuple(inputVolume.GetSpacing()), tuple(inputVolume.GetOrigin()), directions, roi)
+
+  def exportInputVolume(self, inputVolume, fileName, roiExtent=None):
+    """Writes the image data of inputVolume to fileName, unless the same
+    volume content was already written there by a previous run.
+    If roiExtent is given, only that voxel region is written.
+    Returns True if the image was written, False if the existing file was reused.
+    """
+    pendingExport = self.prepareExport(inputVolume, fileName, roiExtent)
+    if pendingExport is None:
+      return False
+    self.writeExport(pendingExport)
+    return True
+
+  def prepareExport(self, inputVolume, fileName, roiExtent=None, shrinkFactor=1, cacheEntry=None, copyVoxels=False):
+    """Takes a snapshot of the image data of inputVolume, or of the roiExtent
+    voxel region of it, for writing to fileName.
+    If shrinkFactor is greater than 1, the image is downsampled by that factor when written.
+    The raw format writes the voxels straight from the volume buffer unless copyVoxels is set,
+    which is needed for volumes updated in place while the file is written (e.g. by OpenIGTLink).
+    The export cache remembers the file under cacheEntry, by default the volume node ID for the whole
+    volume and the node ID followed by -roi for a region, so that exporting a region keeps the whole volume file.
+    Returns None if the file already holds the same volume content.
+    """
+    self.observeScene()
+    cacheEntry = cacheEntry or (inputVolume.GetID() if roiExtent is None else inputVolume.GetID() + '-roi')
+    cacheKey = self.getExportCacheKey(inputVolume, roiExtent) + (shrinkFactor,)
+    cachedEntry = self.exportCache.get(cacheEntry)
+    if cachedEntry == (cacheKey, fileName) and os.path.exists(fileName):
+      self.exportCacheHits += 1
+      logging.debug('prepareExport: reusing ' + fileName)
+      return None
+    self.exportCacheMisses += 1
+
+    spacing = inputVolume.GetSpacing()
+    origin = inputVolume.GetOrigin()
+    if self.exportFormat == 'raw' and shrinkFactor == 1:
+      # No copy: the scalars are written straight from the volume buffer, which must not change until written
+      array = slicer.util.arrayFromVolume(inputVolume)
+      if roiExtent is not None:
+        origin = [origin[i] + roiExtent[2 * i] * spacing[i] for i in range(3)]
+      if copyVoxels:
+        if roiExtent is not None:
+          array = array[roiExtent[4]:roiExtent[5] + 1, roiExtent[2]:roiExtent[3] + 1, roiExtent[0]:roiExtent[1] + 1]
+        return {'nodeID': cacheEntry, 'cacheKey': cacheKey, 'fileName': fileName, 'format': 'raw',
+                'array': numpy.array(array), 'imageData': None, 'roiExtent': None, 'spacing': spacing, 'origin': origin}
+      return {'nodeID': cacheEntry, 'cacheKey': cacheKey, 'fileName': fileName, 'format': 'raw',
+              'array': array, 'imageData': inputVolume.GetImageData(),
+              'roiExtent': roiExtent, 'spacing': spacing, 'origin': origin}
+
+    imgData = vtk.vtkImageData()
+    if roiExtent is None:
+      imgData.DeepCopy(inputVolume.GetImageData())
+    else:
+      extractVoi = vtk.vtkExtractVOI()
+      extractVoi.SetInputData(inputVolume.GetImageData())
+      extractVoi.SetVOI(roiExtent)
+      extractVoi.Update()
+      imgData.DeepCopy(extractVoi.GetOutput())
+      # Start the extent at zero and move the origin instead, so that physical coordinates
+      # in the cropped image are the same as in the full volume
+      imgData.SetExtent(0, roiExtent[1] - roiExtent[0], 0, roiExtent[3] - roiExtent[2], 0, roiExtent[5] - roiExtent[4])
+      origin = [origin[i] + roiExtent[2 * i] * spacing[i] for i in range(3)]
+    imgData.SetSpacing(spacing)
+    imgData.SetOrigin(origin)
+    return {'nodeID': cacheEntry, 'cacheKey': cacheKey, 'fileName': fileName, 'format': 'mha',
+            'imageData': imgData, 'shrinkFactor': shrinkFactor}
+
+  # MetaImage element types of numpy scalar types
+  metaImageElementTypes = {'int8': 'MET_CHAR', 'uint8': 'MET_UCHAR', 'int16': 'MET_SHORT', 'uint16': 'MET_USHORT',
+                           'int32': 'MET_INT', 'uint32': 'MET_UINT', 'int64': 'MET_LONG_LONG', 'uint64': 'MET_ULONG_LONG',
+                           'float32': 'MET_FLOAT', 'float64': 'MET_DOUBLE'}
+
+  def writeExport(self, pendingExport):
+    """Writes an image snapshot taken by prepareExport to disk.
+    Does not access the scene, so it may be called from a worker thread.
+    The number of bytes written and the time taken are stored in lastExportStatistics.
+    """
+    startTime = time.time()
+    fileName = pendingExport['fileName']
+    if pendingExport['format'] == 'raw':
+      bytesWritten = self.writeRawExport(pendingExport)
+    else:
+      imageData = pendingExport['imageData']
+      if pendingExport.get('shrinkFactor', 1) > 1:
+        # the origin is kept, so physical coordinates are the same as in the full resolution image
+        resample = vtk.vtkImageResample()
+        resample.SetInputData(imageData)
+        for axis in range(3):
+          resample.SetAxisMagnificationFactor(axis, 1.0 / pendingExport['shrinkFactor'])
+        resample.SetInterpolationModeToLinear()
+        resample.Update()
+        imageData = resample.GetOutput()
+      writer = vtk.vtkMetaImageWriter()
+      writer.SetFileName(fileName)
+      writer.SetCompression(False)
+      writer.SetInputData(imageData)
+      writer.Write()
+      bytesWritten = os.path.getsize(fileName)
+    exportStatistics = {'format': pendingExport['format'], 'bytes': bytesWritten, 'seconds': time.time() - startTime}
+    self.lastExportStatistics = exportStatistics
+
+    # The raw format writes the volume buffer itself: if the image data was modified since prepareExport,
+    # the file may hold newer voxels than the cache key describes, so it is not cached
+    imageData = pendingExport['imageData'] if pendingExport['format'] == 'raw' else None
+    upToDate = imageData is None or imageData.GetMTime() == pendingExport['cacheKey'][0]
+    with self.exportCacheLock:
+      # Any other volume previously written to the same file is no longer on disk
+      for nodeID in [nodeID for nodeID, entry in self.exportCache.items() if entry[1] == fileName]:
+        del self.exportCache[nodeID]
+      if upToDate:
+        self.exportCache[pendingExport['nodeID']] = (pendingExport['cacheKey'], fileName)
+      else:
+        self.exportCache.pop(pendingExport['nodeID'], None)
+        logging.debug('writeExport: volume modified while writing ' + fileName + ', not cached')
+    return exportStatistics
+
+  def writeRawExport(self, pendingExport):
+    """Writes the voxel array of pendingExport as an uncompressed MetaImage .mhd header
+    and .raw data file pair, without an intermediate copy of the volume.
+    Returns the number of bytes written.
+    """
+    array = pendingExport['array']  # k, j, i (, component) order, as MetaImage stores voxels
+    roiExtent = pendingExport['roiExtent']
+    if roiExtent is not None:
+      array = array[roiExtent[4]:roiExtent[5] + 1, roiExtent[2]:roiExtent[3] + 1, roiExtent[0]:roiExtent[1] + 1]
+    elementType = self.metaImageElementTypes.get(array.dtype.name)
+    if elementType is None:
+      raise ValueError('Scalar type ' + array.dtype.name + ' cannot be exported')
+    numberOfComponents = array.shape[3] if array.ndim == 4 else 1
+
+    headerFileName = pendingExport['fileName']
+    rawFileName = os.path.splitext(headerFileName)[0] + '.raw'
+    with open(rawFileName, 'wb') as rawFile:
+      if array.flags.c_contiguous:
+        array.tofile(rawFile)
+      else:
+        # cropped region: copy one slice at a time instead of the whole region
+        for sliceArray in array:
+          numpy.ascontiguousarray(sliceArray).tofile(rawFile)
+
+    spacing = pendingExport['spacing']
+    origin = pendingExport['origin']
+    header = [
+      'ObjectType = Image',
+      'NDims = 3',
+      'BinaryData = True',
+      'BinaryDataByteOrderMSB = ' + str(array.dtype.byteorder == '>' or (array.dtype.byteorder == '=' and sys.byteorder == 'big')),
+      'CompressedData = False',
+      'TransformMatrix = 1 0 0 0 1 0 0 0 1',
+      'Offset = {0:.10} {1:.10} {2:.10}'.format(float(origin[0]), float(origin[1]), float(origin[2])),
+      'ElementSpacing = {0:.10} {1:.10} {2:.10}'.format(float(spacing[0]), float(spacing[1]), float(spacing[2])),
+      'DimSize = {0} {1} {2}'.format(array.shape[2], array.shape[1], array.shape[0]),
+      'ElementNumberOfChannels = {0}'.format(numberOfComponents),
+      'ElementType = ' + elementType,
+      'ElementDataFile = ' + os.path.basename(rawFileName),
+      ]
+    with open(headerFileName, 'w') as headerFile:
+      headerFile.write('\n'.join(header) + '\n')
+    return os.path.getsize(headerFileName) + os.path.getsize(rawFileName)
+
+  def computeSeedRoiExtent(self, inputVolume, seedPoint, imageDirections, insertAngle):
+    """Returns the voxel extent of the box exported around seedPoint (in the coordinates
+    of the exported image) when the ROI mode is enabled, or None if the box covers the whole volume.
+    The box contains a needle of length roiLength through the seed at insertAngle degrees from the
+    A-P axis, at any rotation around that axis, plus roiMargin on every side.
+    """
+    spacing = inputVolume.GetSpacing()
+    origin = inputVolume.GetOrigin()
+    fullExtent = inputVolume.GetImageData().GetExtent()
+    angle = numpy.radians(insertAngle)
+    halfLength = self.roiLength / 2.0
+
+    roiExtent = []
+    for axis in range(3):
+      # component of the A-P direction along this axis of the exported image
+      apComponent = min(abs(imageDirections[axis, 1]), 1.0)
+      halfSize = halfLength * (apComponent * abs(numpy.cos(angle)) + numpy.sqrt(1.0 - apComponent ** 2) * abs(numpy.sin(angle)))
+      halfSize += self.roiMargin
+      seedIndex = (seedPoint[axis] - origin[axis]) / spacing[axis]
+      halfSizeIndex = halfSize / spacing[axis]
+      roiExtent.append(max(fullExtent[2 * axis], int(numpy.floor(seedIndex - halfSizeIndex))))
+      roiExtent.append(min(fullExtent[2 * axis + 1], int(numpy.ceil(seedIndex + halfSizeIndex))))
+
+    if any(roiExtent[2 * axis] > roiExtent[2 * axis + 1] for axis in range(3)):
+      logging.warning('Seed point is outside of the image, exporting the whole volume')
+      return None
+    if list(roiExtent) == list(fullExtent):
+      return None
+    return roiExtent
+
+  def computePointsRoiExtent(self, inputVolume, points, margin):
+    """Returns the voxel extent of the bounding box of points (in the coordinates of the exported image)
+    enlarged by margin (mm) on every side, clipped to the volume, or None if it covers the whole volume.
+    """
+    return self.computeExtentAroundPoints(points, margin, inputVolume.GetSpacing(), inputVolume.GetOrigin(),
+                                          inputVolume.GetImageData().GetExtent())
+
+  def computeExtentAroundPoints(self, points, margin, spacing, origin, fullExtent):
+    """Same as computePointsRoiExtent, for an image of the given geometry
+    """
+    points = numpy.array(points, dtype=float)[:, :3]
+    lowIndex = numpy.floor((points.min(axis=0) - margin - origin) / spacing).astype(int)
+    highIndex = numpy.ceil((points.max(axis=0) + margin - origin) / spacing).astype(int)
+
+    roiExtent = []
+    for axis in range(3):
+      roiExtent.append(max(fullExtent[2 * axis], int(lowIndex[axis])))
+      roiExtent.append(min(fullExtent[2 * axis + 1], int(highIndex[axis])))
+
+    if any(roiExtent[2 * axis] > roiExtent[2 * axis + 1] for axis in range(3)):
+      logging.warning('Region is outside of the image, exporting the whole volume')
+      return None
+    if list(roiExtent) == list(fullExtent):
+      return None
+    return roiExtent
+
+  def distanceToSegment(self, point, start, end):
+    """Returns the distance between point and the line segment from start to end
+    """
+    point = numpy.array(point[:3], dtype=float)
+    start = numpy.array(start[:3], dtype=float)
+    segment = numpy.array(end[:3], dtype=float) - start
+    lengthSquared = segment.dot(segment)
+    t = 0.0 if lengthSquared == 0 else numpy.clip((point - start).dot(segment) / lengthSquared, 0.0, 1.0)
+    return float(numpy.linalg.norm(point - (start + t * segment)))
+
+  def setScratchRoot(self, scratchRoot):
+    """Sets the directory below which temporary files are written. Files of previous runs are removed.
+    """
+    if scratchRoot == self.scratchRoot:
+      return
+    self.removeScratchDirectory()
+    self.scratchRoot = scratchRoot
+
+  def getScratchDirectory(self):
+    """Returns the temporary directory of this logic instance, created on first use.
+    Exported volumes are kept there between runs, each run gets its own subdirectory.
+    """
+    if self.scratchDirectory is None or not os.path.isdir(self.scratchDirectory):
+      self.scratchDirectory = tempfile.mkdtemp(prefix='StaticNeedleSegmentation-', dir=self.scratchRoot)
+      atexit.register(shutil.rmtree, self.scratchDirectory, True)
+    return self.scratchDirectory
+
+  def removeScratchDirectory(self):
+    if self.scratchDirectory is not None:
+      shutil.rmtree(self.scratchDirectory, ignore_errors=True)
+      self.scratchDirectory = None
+    self.clearExportCache()
+
+  def releaseRun(self, segmentationRun):
+    """Removes the temporary files of a run
+    """
+    if segmentationRun.workingDirectory is not None:
+      shutil.rmtree(segmentationRun.workingDirectory, ignore_errors=True)
+      segmentationRun.workingDirectory = None
+    segmentationRun.voxels = None
+    segmentationRun.pyramidSource = None
+    segmentationRun.diskCacheSource = None
+
+  def removeCachedExport(self, nodeID):
+    """Forgets the exported image of a volume and deletes its file
+    """
+    with self.exportCacheLock:
+      # the volume itself, its regions and its pyramid levels
+      entries = [self.exportCache.pop(entryName) for entryName in list(self.exportCache.keys())
+                 if entryName == nodeID or entryName.startswith(nodeID + '-')]
+    for entry in entries:
+      for fileName in [entry[1], os.path.splitext(entry[1])[0] + '.raw']:
+        if os.path.exists(fileName):
+          os.remove(fileName)
+
+  def cleanup(self):
+    """Stops tracking, seed watching and the segmentation worker and removes all temporary files
+    """
+    self.stopTracking()
+    self.stopSeedWatching()
+    self.stopWorker()
+    self.removeScratchDirectory()
+    for volumeTransform in self.volumeTransforms.values():
+      volumeTransform.release()
+    self.volumeTransforms = {}
+    if self.sceneObserverTag is not None:
+      slicer.mrmlScene.RemoveObserver(self.sceneObserverTag)
+      self.sceneObserverTag = None
+
+  def exportFileExtension(self):
+    return 'mhd' if self.exportFormat == 'raw' else 'mha'
+
+  def getExportCacheStatistics(self):
+    """Returns the number of export cache hits and misses since the logic was created
+    """
+    return {'hits': self.exportCacheHits, 'misses': self.exportCacheMisses}
+
+  def clearExportCache(self):
+    with self.exportCacheLock:
+      self.exportCache = {}
+
+  def getVolumeContentHash(self, nodeID, exportCacheKey, array):
+    """Returns a hash of the voxel values (array) and geometry of a volume node, whose export cache key
+    (see getExportCacheKey) is exportCacheKey. The hash is only recomputed when the key has changed.
+    Does not access the scene, so it may be called from a worker thread.
+    """
+    cachedHash = self.volumeHashes.get(nodeID)
+    if cachedHash is not None and cachedHash[0] == exportCacheKey:
+      return cachedHash[1]
+    contentHash = hashlib.sha1(numpy.ascontiguousarray(array).data)
+    contentHash.update(repr(exportCacheKey[1:]).encode())  # spacing, origin and directions
+    self.volumeHashes[nodeID] = (exportCacheKey, contentHash.hexdigest())
+    return contentHash.hexdigest()
+
+  def getResultCacheKey(self, volumeKey, resultCacheParameters):
+    """Returns the key under which a result is cached. volumeKey identifies the volume: its node ID and
+    export cache key in memory, its content hash on disk. resultCacheParameters are returned by getResultCacheParameters.
+    """
+    return repr((volumeKey, resultCacheParameters))
+
+  def getResultCacheParameters(self, seedPoints_slicer, volumeTransform, insertAngle, enableRoi, roiPoints=None,
+                               backend=None, pyramid=False):
+    """Returns the inputs of a run (seedPoints_slicer: list of RAS seeds) other than the volume, as a result cache key part
+    """
+    quantizedSeed = tuple(tuple(int(round(c / self.resultCacheSeedTolerance)) for c in seedPoint[:3]) for seedPoint in seedPoints_slicer)
+    transform = volumeTransform.getCacheKey()
+    backend = backend or self.getBackend()
+    if backend.exportsImage:
+      executableTime = os.path.getmtime(self.executablePath) if os.path.exists(self.executablePath) else None
+      parameters = (backend.name, self.executablePath, executableTime, bool(enableRoi))
+    else:
+      parameters = (backend.name, sorted(vars(backend).items()), insertAngle, bool(enableRoi))
+    if enableRoi:
+      parameters += (insertAngle, self.roiLength, self.roiMargin)
+    if roiPoints is not None:
+      parameters += (tuple(tuple(round(c, 3) for c in point[:3]) for point in roiPoints), self.reseedMargin)
+    if pyramid:
+      parameters += ('pyramid', self.pyramidShrinkFactor, self.pyramidMargin)
+    return (quantizedSeed, transform, parameters)
+
+  def getCachedResult(self, resultCacheKey):
+    """Returns the algorithm output cached in memory for resultCacheKey, or None
+    """
+    with self.resultCacheLock:
+      outputFromExe = self.resultCache.get(resultCacheKey)
+      if outputFromExe is not None:
+        self.resultCache[resultCacheKey] = self.resultCache.pop(resultCacheKey)  # most recently used
+    if outputFromExe is None:
+      self.resultCacheMisses += 1
+    else:
+      self.resultCacheHits += 1
+    return outputFromExe
+
+  def getDiskCachedResult(self, resultCacheKey, diskCacheKey):
+    """Returns the algorithm output cached in resultCacheDirectory for diskCacheKey, or None.
+    A result found is also cached in memory under resultCacheKey. Unreadable files are ignored.
+    """
+    fileName = self.getResultCacheFileName(diskCacheKey)
+    if not os.path.exists(fileName):
+      return None
+    try:
+      with open(fileName) as resultFile:
+        entry = json.load(resultFile)
+      if entry.get('key') != diskCacheKey:
+        return None
+      outputFromExe = entry['output']
+    except (IOError, ValueError, KeyError, AttributeError) as e:
+      logging.warning('Ignoring unreadable cached result ' + fileName + ': ' + str(e))
+      return None
+    self.resultCacheDiskHits += 1
+    self.storeCachedResult(resultCacheKey, outputFromExe)
+    return outputFromExe
+
+  def storeCachedResult(self, resultCacheKey, outputFromExe, diskCacheKey=None):
+    """Caches a result in memory under resultCacheKey, and in resultCacheDirectory under diskCacheKey if given
+    """
+    with self.resultCacheLock:
+      self.resultCache.pop(resultCacheKey, None)
+      self.resultCache[resultCacheKey] = outputFromExe
+      while len(self.resultCache) > max(self.resultCacheSize, 0):
+        self.resultCache.popitem(last=False)  # least recently used
+    if diskCacheKey is not None and self.resultCacheDirectory:
+      if not os.path.isdir(self.resultCacheDirectory):
+        os.makedirs(self.resultCacheDirectory)
+      with open(self.getResultCacheFileName(diskCacheKey), 'w') as resultFile:
+        json.dump({'key': diskCacheKey, 'output': outputFromExe}, resultFile)
+
+  def getResultCacheFileName(self, resultCacheKey):
+    return os.path.join(self.resultCacheDirectory, hashlib.sha1(resultCacheKey.encode()).hexdigest() + '.json')
+
+  def invalidateResultCache(self, removeFromDisk=True):
+    """Forgets all cached segmentation results, including those kept on disk unless removeFromDisk is False
+    """
+    with self.resultCacheLock:
+      self.resultCache.clear()
+    self.volumeHashes = {}
+    if removeFromDisk and self.resultCacheDirectory and os.path.isdir(self.resultCacheDirectory):
+      for fileName in os.listdir(self.resultCacheDirectory):
+        if fileName.endswith('.json'):
+          os.remove(os.path.join(self.resultCacheDirectory, fileName))
+
+  def getResultCacheStatistics(self):
+    """Returns the number of result cache hits and misses in memory, and of hits on disk
+    after a miss in memory, since the logic was created
+    """
+    return {'hits': self.resultCacheHits, 'misses': self.resultCacheMisses, 'diskHits': self.resultCacheDiskHits,
+            'size': len(self.resultCache)}
+
+  def registerBackend(self, backend):
+    """Makes a StaticNeedleSegmentationBackend selectable by its name, in the widget
+    (see updateBackendSelector) and on the command line
+    """
+    self.backends[backend.name] = backend
+
+  def getBackend(self, backendName=None):
+    """Returns the backend named backendName, or the default backend (backendName attribute)
+    """
+    backendName = backendName or self.backendName
+    if backendName not in self.backends:
+      raise ValueError('Unknown segmentation backend: ' + str(backendName))
+    return self.backends[backendName]
+
+  def getExecutableCommand(self):
+    """Returns the command line that starts the segmentation executable, without its arguments
+    """
+    if self.executableLauncher:
+      return [self.executableLauncher, self.executablePath]
+    return [self.executablePath]
+
+  def startWorker(self):
+    """Starts the persistent segmentation worker if the executable supports it.
+    Returns True if a worker is running.
+    """
+    if self.worker is not None and self.worker.isRunning():
+      return True
+    if not self.useWorker or self.workerSupported is False:
+      return False
+    self.worker = StaticNeedleSegmentationWorker(self.getExecutableCommand())
+    if self.worker.start():
+      self.workerSupported = True
+      return True
+    logging.info('Segmentation executable does not support worker mode, using one-shot calls')
+    self.worker = None
+    self.workerSupported = False
+    return False
+
+  def stopWorker(self):
+    if self.worker is not None:
+      self.worker.stop()
+      self.worker = None
+
+  def segmentWithExecutable(self, imagePath, seedPoint, allowWorker=True):
+    """Runs the segmentation executable on the image file for one seed point
+    and returns its output as a string.
+    Uses the persistent worker when available and allowWorker is set, a one-shot call otherwise.
+    One-shot calls may run concurrently from several threads, the worker may not.
+    """
+    if allowWorker and self.startWorker():
+      try:
+        return self.worker.segment(imagePath, seedPoint)
+      except StaticNeedleSegmentationError:
+        # the worker is fine, running the request again would give the same error
+        raise
+      except RuntimeError as e:
+        self.stopWorker()
+        if self.cancelRequested:
+          raise
+        logging.warning(str(e) + ', falling back to a one-shot call')
+
+    commandLineCall = self.getExecutableCommand() + [imagePath] + ["{0:.10}".format(float(c)) for c in seedPoint[:3]]
+    print("Command line call: " + " ".join(commandLineCall))
+    process = subprocess.Popen(commandLineCall, stdout=subprocess.PIPE, universal_newlines=True)
+    self.activeProcesses.add(process)
+    try:
+      outputFromExe = process.communicate()[0]
+    finally:
+      self.activeProcesses.discard(process)
+    if process.returncode != 0:
+      raise subprocess.CalledProcessError(process.returncode, commandLineCall, outputFromExe)
+    return outputFromExe
+
   def takeScreenshot(self,name,description,type=-1):
     # show the message even if not taking a screen shot
     slicer.util.delayDisplay('Take screenshot: '+description+'.\nResult is available in the Annotations module.', 3000)
@@ -262,206 +1978,882 @@ class StaticNeedleSegmentationLogic(ScriptedLoadableModuleLogic):
     annotationLogic = slicer.modules.annotations.logic()
     annotationLogic.CreateSnapShot(name, description, type, 1, imageData)
 
-  def compareToManualSeg(self, tip, tail , manSegPoints, insertAngle):
-    # get manually selected point
-    manualTip = [0.0, 0.0, 0.0]
-    manSegPoints.GetNthFiducialPosition(0, manualTip)
-    # manualTipString = "{0:.10} {1:.10} {2:.10}".format(manualTip[0], manualTip[1], manualTip[2])
-    # print("manual tip: " + manualTipString)
+  # Columns of the Metrics table, in the order returned by computeMetrics
+  metricsColumnNames = ['Tip Difference (mm)', 'Active Tip Difference (mm)', 'Trajectory Difference (deg)',
+                        'Segmented Insertion Angle (deg)', 'Insertion Angle Difference (deg)']
+
+  def computeMetrics(self, tip, tail, manualTip, insertAngle):
+    """Compares a segmentation to a manually selected tip. Returns the tip error,
+    active tip error, trajectory error, segmented insertion angle and insertion angle error
+    """
+    return list(self.computeMetricsArray([tip], [tail], [manualTip], [insertAngle])[0])
+
+  def computeMetricsArray(self, tips, tails, manualTips, insertAngles):
+    """Compares N segmentations to manually selected tips at once. tips, tails and manualTips
+    are Nx3 arrays (RAS), insertAngles a scalar or N values (degrees).
+    Returns an Nx5 array with the metricsColumnNames columns: tip error, active tip error,
+    trajectory error, segmented insertion angle and insertion angle error.
+    """
+    tips = numpy.asarray(tips, dtype=float).reshape(-1, 3)
+    tails = numpy.asarray(tails, dtype=float).reshape(-1, 3)
+    manualTips = numpy.asarray(manualTips, dtype=float).reshape(-1, 3)
+    insertAngles = numpy.asarray(insertAngles, dtype=float)
 
     # calculate the distance between needle tips
-    tipError = numpy.sqrt((tip[0]-manualTip[0])**2 + (tip[1]-manualTip[1])**2 + (tip[2]-manualTip[2])**2)
-    tipErrorString = "{0:.10}".format(tipError)
-    print("Tip error is " + tipErrorString + " mm.")
-
-    # calculate the directional vectors for the algorithm and manual segmentations
-    algoVector = [a - b for a, b in zip(tip, tail)]
-    manualVector = [a - b for a, b in zip(manualTip, tail)]
-
-    # normalize the vectors
-    algoLength = numpy.sqrt(algoVector[0]**2 + algoVector[1]**2 + algoVector[2]**2)
-    manualLength = numpy.sqrt(manualVector[0] ** 2 + manualVector[1] ** 2 + manualVector[2] ** 2)
-    algoVector = [a / algoLength for a in algoVector]
-    manualVector = [a / manualLength for a in manualVector]
-
-    # calculate the dot product and compute the trajectory difference
-    dotProduct = numpy.dot(algoVector, manualVector)
-    trajError = numpy.arccos(dotProduct)
-    trajError = numpy.degrees(trajError)
-    trajErrorString = "{0:.10}".format(trajError)
-    print("Trajectory error is " + trajErrorString + " degrees.")
-
-    # calculate the active tip error
-    algoActTip = [a * 10 for a in algoVector]
-    algoActTip = [a - b for a,b in zip(tip, algoActTip)]
-    manualActTip = [a * 10 for a in manualVector]
-    manualActTip = [a - b for a,b in zip(manualTip, manualActTip)]
-    actTipError = numpy.sqrt((algoActTip[0] - manualActTip[0]) ** 2 + (algoActTip[1] - manualActTip[1]) ** 2 + (algoActTip[2] - manualActTip[2]) ** 2)
-    actTipErrorString = "{0:.10}".format(actTipError)
-    print("Active tip error is " + actTipErrorString + " mm.")
-
-    # calculate the difference from expected insertion angle
-    insertString = "{0:.10}".format(insertAngle)
-    print("Expected insertion angle is " + insertString + " degrees.")
-
-    # calculate insertion angle of algorithmically segmented needle
-    dotProduct = -1 * algoVector[1]
-    algoAngle = numpy.arccos(dotProduct)
-    algoAngle = numpy.degrees(algoAngle)
-    algoAngleString = "{0:.10}".format(algoAngle)
-    print("Segmented insertion angle is " + algoAngleString + " degrees.")
-
-    # calculate insertion angle error
-    angleDiff = numpy.absolute(insertAngle - algoAngle)
-    angleDiffString = "{0:.10}".format(angleDiff)
-    print("Insertion angle difference is " + angleDiffString + " degrees.")
-
-    # check if a metrics table has already been created
-    if not slicer.util.getNode('Metrics'):
-      tableNode = slicer.vtkMRMLTableNode()
-      tableNode.SetName('Metrics')
-      col = tableNode.AddColumn()
-      col.SetName('Tip Difference (mm)')
-      col = tableNode.AddColumn()
-      col.SetName('Active Tip Difference (mm)')
-      col = tableNode.AddColumn()
-      col.SetName('Trajectory Difference (deg)')
-      col = tableNode.AddColumn()
-      col.SetName('Segmented Insertion Angle (deg)')
-      col = tableNode.AddColumn()
-      col.SetName('Insertion Angle Difference (deg)')
-      slicer.mrmlScene.AddNode(tableNode)
-    else:
-      tableNode = slicer.util.getNode('Metrics')
+    tipErrors = numpy.linalg.norm(tips - manualTips, axis=1)
 
-    # populates a table with the metrics values
-    tableNode.AddEmptyRow()
-    row = tableNode.GetNumberOfRows() - 1
-    tableNode.SetCellText(row, 0, tipErrorString)
-    tableNode.SetCellText(row, 1, actTipErrorString)
-    tableNode.SetCellText(row, 2, trajErrorString)
-    tableNode.SetCellText(row, 3, algoAngleString)
-    tableNode.SetCellText(row, 4, angleDiffString)
+    # calculate the normalized directional vectors for the algorithm and manual segmentations
+    algoVectors = tips - tails
+    manualVectors = manualTips - tails
+    algoVectors /= numpy.linalg.norm(algoVectors, axis=1)[:, numpy.newaxis]
+    manualVectors /= numpy.linalg.norm(manualVectors, axis=1)[:, numpy.newaxis]
 
-  def run(self, inputVolume, inputSeedFiducial, outputPoints, manSegPoints, insertAngle, enableNeedleModels,enableScreenshots=0):
-    """
-    Run the actual algorithm
-    """
+    # calculate the dot products and compute the trajectory differences
+    dotProducts = numpy.clip(numpy.einsum('ij,ij->i', algoVectors, manualVectors), -1.0, 1.0)
+    trajErrors = numpy.degrees(numpy.arccos(dotProducts))
 
-    # if not self.isValidInputOutputData(inputVolume, outputVolume):
-    #   slicer.util.errorDisplay('Input volume is the same as output volume. Choose a different output volume.')
-    #   return False
+    # calculate the active tip errors (10 mm back from the tip along the needle)
+    actTipErrors = numpy.linalg.norm((tips - 10 * algoVectors) - (manualTips - 10 * manualVectors), axis=1)
 
-    logging.info('Processing started')
-    print(enableNeedleModels)
-    #Hard coded parameters for passing between slicer and executable through files on disk
-    inputImageFileName = 'inputImage.mha'
-    outputResultsFileName = 'segmentationOutput.txt'
-    exeName = 'StaticNeedleTestBed'
+    # calculate insertion angles of algorithmically segmented needles, relative to the A-P axis
+    algoAngles = numpy.degrees(numpy.arccos(numpy.clip(-1 * algoVectors[:, 1], -1.0, 1.0)))
 
-    dir_path = os.path.dirname(os.path.realpath(__file__)) #directory script is running from
+    # calculate insertion angle errors
+    angleDiffs = numpy.absolute(insertAngles - algoAngles)
 
-    #Write input image to disk
+    return numpy.column_stack((tipErrors, actTipErrors, trajErrors, algoAngles, angleDiffs))
 
-    imgData = vtk.vtkImageData()
-    imgData.DeepCopy(inputVolume.GetImageData())
-    imgData.SetSpacing(inputVolume.GetSpacing())
-    imgData.SetOrigin(inputVolume.GetOrigin())
-
-    writer = vtk.vtkMetaImageWriter()
-    writer.SetFileName(os.path.join(dir_path,inputImageFileName))
-    writer.SetInputData(imgData)
-    writer.Write()
-
-
-    inputImageFullPath = os.path.join(dir_path, inputImageFileName)
-    #print(dir_path)
-    # storageNode = inputVolume.CreateDefaultStorageNode()
-    # storageNode.SetFileName(inputImageFullPath)
-    # inputVolume.AddAndObserveStorageNodeID(storageNode.GetID())
-    # storageNode.WriteData(inputVolume)
-    print('Image successfully written to ' + inputImageFullPath)
-
-    #Get seed point
-    seedPoint_slicer = [0.0, 0.0, 0.0]  # seedPoint in RAS coordinates of slicer
-    inputSeedFiducial.GetNthFiducialPosition(0, seedPoint_slicer)
-    seedPoint_slicer = seedPoint_slicer + [1]  # pad to make homogeneous vector
-    # Transform seed to account for any transforms applied to the image
-    transformID = inputVolume.GetTransformNodeID()
-
-    if transformID != None:  # if image has been transformed
-      transformNode = slicer.mrmlScene.GetNodeByID(transformID)
-      invertedTransformMatrix = transformNode.GetMatrixTransformFromParent()  # applied transform is 'toParent', 'fromParent' is inverse
-      seedPoint_noTrans = [0.0, 0.0, 0.0, 0.0]
-      invertedTransformMatrix.MultiplyPoint(seedPoint_slicer, seedPoint_noTrans)
-    else:
-      seedPoint_noTrans = seedPoint_slicer
+  def getMetricsTable(self):
+    """Returns the Metrics table node, with all buffered rows written, creating it if it does not exist yet
+    """
+    tableNode = self.metricsSink.getTableNode()
+    self.metricsSink.addMissingColumns(tableNode)
+    self.metricsSink.flush(tableNode)
+    return tableNode
+
+  def addMetricsRow(self, metrics, metadata=None, flush=True):
+    self.addMetricsRows([metrics], metadata=metadata, flush=flush)
+
+  def addMetricsRows(self, metrics, tableNode=None, metadata=None, flush=True):
+    """Appends rows of metrics (an Nx5 array as returned by computeMetricsArray)
+    to tableNode, by default the Metrics table, in a single table update.
+    metadata holds the volumeName, seedPoints, backendName and build of the rows (see getRunMetadata).
+    If flush is not set, the rows are buffered by metricsSink until more rows are added or it is flushed.
+    """
+    if tableNode is not None:
+      # rows buffered for the Metrics table stay there
+      self.metricsSink.flush()
+      flush = True
+    self.metricsSink.append(metrics, **(metadata or {}))
+    if flush:
+      self.metricsSink.flush(tableNode)
+
+  def getRunMetadata(self, segmentationRun):
+    """Returns the metadata recorded with the metrics of a run
+    """
+    return {'volumeName': segmentationRun.report.volumeName, 'seedPoints': segmentationRun.rasSeedPoints,
+            'backendName': segmentationRun.backend.name, 'build': segmentationRun.backend.getBuild(self)}
 
-    # Account for ijk to RAS direction matrix (e.g. LPS vs RAS incongruencies)
-    ijkToRasDirs = vtk.vtkMatrix4x4()
-    inputVolume.GetIJKToRASDirectionMatrix(ijkToRasDirs)
-    seedPoint_dirConv = [0.0, 0.0, 0.0, 0.0]  # seed point after correcting for direction conventions (e.g. LPS vs RAS)
-    ijkToRasDirs.MultiplyPoint(seedPoint_noTrans, seedPoint_dirConv)
-    seedPoint_dirConv = seedPoint_dirConv[:3]
+  def getExecutableBuild(self):
+    """Returns the name of the segmentation executable followed by the start of its SHA-1,
+    computed once per version of the file
+    """
+    name = os.path.basename(self.executablePath)
+    try:
+      fileStatus = os.stat(self.executablePath)
+    except OSError:
+      return name
+    buildKey = (self.executablePath, fileStatus.st_mtime, fileStatus.st_size)
+    if buildKey not in self.executableBuilds:
+      contentHash = hashlib.sha1()
+      with open(self.executablePath, 'rb') as executableFile:
+        for chunk in iter(lambda: executableFile.read(1 << 20), b''):
+          contentHash.update(chunk)
+      self.executableBuilds[buildKey] = '{0} {1}'.format(name, contentHash.hexdigest()[:12])
+    return self.executableBuilds[buildKey]
+
+  def compareToManualSeg(self, tip, tail , manSegPoints, insertAngle, metadata=None):
+    # get manually selected point
+    manualTip = [0.0, 0.0, 0.0]
+    manSegPoints.GetNthFiducialPosition(0, manualTip)
+    # manualTipString = "{0:.10} {1:.10} {2:.10}".format(manualTip[0], manualTip[1], manualTip[2])
+    # print("manual tip: " + manualTipString)
+
+    metrics = self.computeMetrics(tip, tail, manualTip, insertAngle)
+    tipError, actTipError, trajError, algoAngle, angleDiff = metrics
+    print("Tip error is " + "{0:.10}".format(tipError) + " mm.")
+    print("Trajectory error is " + "{0:.10}".format(trajError) + " degrees.")
+    print("Active tip error is " + "{0:.10}".format(actTipError) + " mm.")
+    print("Expected insertion angle is " + "{0:.10}".format(insertAngle) + " degrees.")
+    print("Segmented insertion angle is " + "{0:.10}".format(algoAngle) + " degrees.")
+    print("Insertion angle difference is " + "{0:.10}".format(angleDiff) + " degrees.")
+
+    self.addMetricsRow(metrics, metadata)
+
+  def prepareRun(self, inputVolume, seedPoint_slicer, insertAngle=None, enableRoi=False, roiPoints=None, backend=None,
+                 pyramid=False, liveVolume=False):
+    """First stage of a run, must be called on the main thread: snapshots the
+    image to export and computes the seed point (RAS) in image coordinates.
+    seedPoint_slicer is one point, or a list of points for a multi-seed run (one needle per seed).
+    If enableRoi is set, only a region around the seed oriented by insertAngle is exported.
+    If roiPoints (RAS) are given, only their bounding box enlarged by reseedMargin is exported.
+    backend is the name of the segmentation backend, the default backend if None.
+    If pyramid is set, a downsampled image is segmented first, then a full resolution region
+    around the coarse result (backends that export the image only).
+    liveVolume is set for volumes updated continuously (see StaticNeedleSegmentationTracker):
+    their results are not cached, since each frame differs, and their voxels are always copied.
+    Returns a StaticNeedleSegmentationRun to pass to executeRun and finishRun,
+    which must be passed to releaseRun once done.
+    """
+    segmentationRun = StaticNeedleSegmentationRun()
+    segmentationRun.stage = 'export'
+    segmentationRun.backend = self.getBackend(backend)
+    segmentationRun.insertAngle = insertAngle
+    if pyramid and not segmentationRun.backend.exportsImage:
+      logging.warning('Pyramid mode requires a backend that exports the image, segmenting at full resolution')
+      pyramid = False
+    report = segmentationRun.report
+    report.volumeName = inputVolume.GetName()
+    segmentationRun.volumeBounds = [0.0] * 6
+    inputVolume.GetRASBounds(segmentationRun.volumeBounds)
+    report.executablePath = self.executablePath
+
+    seedPoints_slicer = numpy.array(seedPoint_slicer, dtype=float)
+    if seedPoints_slicer.size == 0:
+      raise ValueError('No seed point')
+    segmentationRun.multiSeed = seedPoints_slicer.ndim == 2
+    seedPoints_slicer = seedPoints_slicer.reshape(-1, seedPoints_slicer.shape[-1])[:, :3].tolist()
+
+    with report.timeStage('seedTransform'):
+      # Transform seed to account for any transforms applied to the image
+      # and for the ijk to RAS direction matrix (e.g. LPS vs RAS incongruencies)
+      segmentationRun.volumeTransform = self.getVolumeTransform(inputVolume)
+      segmentationRun.imageDirections = segmentationRun.volumeTransform.getDirections()
+      segmentationRun.seedPoints = segmentationRun.volumeTransform.worldToImage(seedPoints_slicer).tolist()
+      segmentationRun.rasSeedPoints = seedPoints_slicer
+      segmentationRun.seedPoint = segmentationRun.seedPoints[0]
+
+    #Reuse the result of an earlier run with identical inputs
+    #In memory, results are keyed on the volume node and its modification time. The disk cache is keyed
+    #on the volume content, whose hash is computed by executeRun so that it does not block the main thread.
+    if self.enableResultCache and not liveVolume:
+      with report.timeStage('resultCacheLookup'):
+        exportCacheKey = self.getExportCacheKey(inputVolume)
+        resultCacheParameters = self.getResultCacheParameters(seedPoints_slicer, segmentationRun.volumeTransform, insertAngle,
+                                                              enableRoi, roiPoints, segmentationRun.backend, pyramid)
+        segmentationRun.resultCacheKey = self.getResultCacheKey((inputVolume.GetID(),) + exportCacheKey, resultCacheParameters)
+        segmentationRun.outputFromExe = self.getCachedResult(segmentationRun.resultCacheKey)
+      if segmentationRun.outputFromExe is not None:
+        print('Reusing cached segmentation result')
+        report.resultCacheHit = True
+        return segmentationRun
+      if self.resultCacheDirectory:
+        segmentationRun.diskCacheSource = {'nodeID': inputVolume.GetID(), 'exportCacheKey': exportCacheKey,
+                                           'array': slicer.util.arrayFromVolume(inputVolume),
+                                           'parameters': resultCacheParameters}
+
+    if roiPoints is not None:
+      imagePoints = segmentationRun.volumeTransform.worldToImage(roiPoints)
+      segmentationRun.roiExtent = self.computePointsRoiExtent(inputVolume, imagePoints, self.reseedMargin)
+    elif enableRoi:
+      # union of the regions of all seeds
+      seedExtents = [self.computeSeedRoiExtent(inputVolume, seedPoint, segmentationRun.imageDirections, insertAngle)
+                     for seedPoint in segmentationRun.seedPoints]
+      if None not in seedExtents:
+        segmentationRun.roiExtent = [(min if bound % 2 == 0 else max)(extent[bound] for extent in seedExtents) for bound in range(6)]
+
+    if not segmentationRun.backend.exportsImage:
+      with report.timeStage('imageCopy'):
+        segmentationRun.backend.prepare(self, segmentationRun, inputVolume)
+      return segmentationRun
+
+    #Snapshot input image for writing to disk (skipped if the volume has not changed since the last run)
+    #Whole volumes are kept in the scratch directory for reuse by later runs, cropped ones are specific to this run
+    segmentationRun.workingDirectory = tempfile.mkdtemp(prefix='run-', dir=self.getScratchDirectory())
+    try:
+      segmentationRun.backend.prepare(self, segmentationRun, inputVolume)
+      if pyramid:
+        # each level is kept in the scratch directory for reuse by later runs
+        segmentationRun.imagePath = os.path.join(self.getScratchDirectory(), 'inputImage-' + inputVolume.GetID() + '-coarse.mha')
+        with report.timeStage('imageCopy'):
+          segmentationRun.pendingExport = self.prepareExport(inputVolume, segmentationRun.imagePath, segmentationRun.roiExtent,
+                                                             self.pyramidShrinkFactor, inputVolume.GetID() + '-coarse')
+          # No copy unless liveVolume: the refined region is written straight from the volume buffer,
+          # which must not change until written
+          array = slicer.util.arrayFromVolume(inputVolume)
+          segmentationRun.pyramidSource = {
+            'array': numpy.array(array) if liveVolume else array, 'imageData': inputVolume.GetImageData(),
+            'spacing': inputVolume.GetSpacing(), 'origin': inputVolume.GetOrigin(),
+            'fullExtent': inputVolume.GetImageData().GetExtent(), 'cacheKey': self.getExportCacheKey(inputVolume),
+            'cacheEntry': inputVolume.GetID() + '-fine',
+            'fileName': os.path.join(self.getScratchDirectory(), 'inputImage-' + inputVolume.GetID() + '-fine.mhd')}
+        report.exportCacheHit = segmentationRun.pendingExport is None
+        return segmentationRun
+      if segmentationRun.roiExtent is not None:
+        segmentationRun.imagePath = os.path.join(segmentationRun.workingDirectory, 'inputImageRoi.' + self.exportFileExtension())
+      else:
+        segmentationRun.imagePath = os.path.join(self.getScratchDirectory(), 'inputImage-' + inputVolume.GetID() + '.' + self.exportFileExtension())
+      with report.timeStage('imageCopy'):
+        segmentationRun.pendingExport = self.prepareExport(inputVolume, segmentationRun.imagePath, segmentationRun.roiExtent,
+                                                           copyVoxels=liveVolume)
+      report.exportCacheHit = segmentationRun.pendingExport is None
+    except:
+      self.releaseRun(segmentationRun)
+      raise
+    return segmentationRun
+
+  def observeScene(self):
+    """Starts releasing what is kept for volume nodes when they are removed from the scene
+    """
+    if self.sceneObserverTag is None:
+      self.sceneObserverTag = slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.NodeAboutToBeRemovedEvent,
+                                                           self.onNodeAboutToBeRemoved)
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeAboutToBeRemoved(self, caller, event, node):
+    if node is not None and node.IsA('vtkMRMLVolumeNode'):
+      self.releaseVolume(node.GetID())
+
+  def releaseVolume(self, nodeID):
+    """Releases the transform, content hash and exported files kept for the volume node nodeID
+    """
+    self.removeCachedExport(nodeID)
+    volumeTransform = self.volumeTransforms.pop(nodeID, None)
+    if volumeTransform is not None:
+      volumeTransform.release()
+    self.volumeHashes.pop(nodeID, None)
+
+  def getVolumeTransform(self, inputVolume):
+    """Returns the StaticNeedleSegmentationVolumeTransform of inputVolume, kept between runs
+    """
+    self.observeScene()
+    volumeTransform = self.volumeTransforms.get(inputVolume.GetID())
+    if volumeTransform is None or volumeTransform.volumeNode is not inputVolume:
+      if volumeTransform is not None:
+        volumeTransform.release()
+      volumeTransform = StaticNeedleSegmentationVolumeTransform(inputVolume)
+      self.volumeTransforms[inputVolume.GetID()] = volumeTransform
+    return volumeTransform
+
+  def executeRun(self, segmentationRun):
+    """Second stage of a run: writes the image and calls the segmentation algorithm.
+    Does not access the scene, so it may be called from a worker thread.
+    """
+    if segmentationRun.outputFromExe is not None:
+      # cached result
+      return
+    if segmentationRun.diskCacheSource is not None:
+      with segmentationRun.report.timeStage('resultCacheLookup'):
+        source = segmentationRun.diskCacheSource
+        contentHash = self.getVolumeContentHash(source['nodeID'], source['exportCacheKey'], source['array'])
+        segmentationRun.diskCacheKey = self.getResultCacheKey(contentHash, source['parameters'])
+        segmentationRun.outputFromExe = self.getDiskCachedResult(segmentationRun.resultCacheKey, segmentationRun.diskCacheKey)
+      if segmentationRun.outputFromExe is not None:
+        print('Reusing cached segmentation result')
+        segmentationRun.report.resultCacheHit = True
+        return
+    segmentationRun.stage = 'export'
+    if segmentationRun.backend.exportsImage:
+      self.writeRunExport(segmentationRun)
+    if segmentationRun.cancelled:
+      return
 
     #Call needle segmentation algorithm
-    exeFullPath = os.path.join(dir_path,exeName)
-    seedPointString = "{0:.10} {1:.10} {2:.10}".format(seedPoint_dirConv[0], seedPoint_dirConv[1], seedPoint_dirConv[2])
-    commandLineCall = "\"" + exeFullPath + "\"" + " " + "\"" + inputImageFullPath + "\"" + " " + seedPointString
-    outputFromExe = subprocess.check_output(commandLineCall )
+    segmentationRun.stage = 'segment'
+    usesWorker = segmentationRun.useWorker and isinstance(segmentationRun.backend, StaticNeedleSegmentationExecutableBackend)
+    if usesWorker and self.worker is not None and self.worker.isRunning():
+      self.worker.resetPeakMemory()
+    if segmentationRun.pyramidSource is not None:
+      #Segment the downsampled image, then refine at full resolution around the result
+      with segmentationRun.report.timeStage('coarseSegmentation'):
+        coarseResults = self.parseResults(self.segmentSeeds(segmentationRun))
+      if segmentationRun.cancelled:
+        return
+      self.prepareRefinement(segmentationRun, coarseResults)
+      self.writeRunExport(segmentationRun)
+      if segmentationRun.cancelled:
+        return
+    seedPointString = ", ".join("{0:.10} {1:.10} {2:.10}".format(seedPoint_dirConv[0], seedPoint_dirConv[1], seedPoint_dirConv[2])
+                                for seedPoint_dirConv in segmentationRun.seedPoints)
+    with segmentationRun.report.timeStage('segmentation'):
+      outputFromExe = self.segmentSeeds(segmentationRun)
     #  'C:\\1-Projects\\StaticNeedleTestBed_VS_2013\\x64\\Release\\StaticNeedleTestBed C:\\1-Projects\\StaticNeedleTestBed_VS_2013\\x64\\Release\\LeftAngle45med.mha 91.6299 27.8934 66.8955')
 
-
     #print("Input image full path: " + inputImageFullPath)
-    print("Command line call: " + commandLineCall)
     print("Output from exe: " + outputFromExe)
     print("seed point: " + seedPointString)
+    segmentationRun.outputFromExe = outputFromExe
+    if usesWorker and self.worker is not None and self.worker.isRunning():
+      segmentationRun.report.workerPeakRssBytes = self.worker.getPeakMemory()
+    if segmentationRun.resultCacheKey is not None and not segmentationRun.cancelled:
+      self.storeCachedResult(segmentationRun.resultCacheKey, outputFromExe, segmentationRun.diskCacheKey)
+
+  def writeRunExport(self, segmentationRun):
+    """Writes the image snapshot of a run, unless the file on disk is up to date
+    """
+    if segmentationRun.pendingExport is not None:
+      with segmentationRun.report.timeStage('imageWrite'):
+        exportStatistics = self.writeExport(segmentationRun.pendingExport)
+      segmentationRun.pendingExport = None
+      segmentationRun.report.bytesWritten += exportStatistics['bytes']
+      print('Image successfully written to ' + segmentationRun.imagePath +
+            ' ({bytes} bytes in {seconds:.3f} s)'.format(**exportStatistics))
+    else:
+      print('Image unchanged, reusing ' + segmentationRun.imagePath)
 
-    #Pass results of algorithm to output markups fiducial
-    outputPoints.RemoveAllMarkups()
-    outputFromExe_floats = map(float, outputFromExe.split())
-    rasToIjkDirs = vtk.vtkMatrix4x4()
-    vtk.vtkMatrix4x4.Invert(ijkToRasDirs, rasToIjkDirs)  # transform usually symmetrical (T = T^-1) but invert to be sure
-    tip = [0, 0, 0, 0]
-    tail = [0, 0, 0, 0]
-    rasToIjkDirs.MultiplyPoint(outputFromExe_floats[:3] + [1], tip)
-    rasToIjkDirs.MultiplyPoint(outputFromExe_floats[3:6] + [1], tail)
-
-    ##reapply transform (if present) to output points
-    if transformID != None:  # if image has been transformed
-      transformMatrix = transformNode.GetMatrixTransformToParent()  # applied transform is 'toParent', 'fromParent' is inverse
-      transformMatrix.MultiplyPoint(tip, tip)
-      transformMatrix.MultiplyPoint(tail, tail)
+  def prepareRefinement(self, segmentationRun, coarseResults):
+    """Selects the full resolution region around the seeds and the coarse needles of a
+    pyramid run for export, reusing the file of an earlier run with the same region.
+    Does not access the scene, so it may be called from a worker thread.
+    """
+    source = segmentationRun.pyramidSource
+    points = list(segmentationRun.seedPoints)
+    for result in coarseResults:
+      points += [result.tip, result.tail]
+    roiExtent = self.computeExtentAroundPoints(points, self.pyramidMargin, source['spacing'], source['origin'], source['fullExtent'])
+    cacheKey = source['cacheKey'][:-1] + (tuple(roiExtent) if roiExtent is not None else None, 1)
+    segmentationRun.roiExtent = roiExtent
+    segmentationRun.imagePath = source['fileName']
+    with self.exportCacheLock:
+      cachedEntry = self.exportCache.get(source['cacheEntry'])
+    if cachedEntry == (cacheKey, source['fileName']) and os.path.exists(source['fileName']):
+      self.exportCacheHits += 1
+      return
+    self.exportCacheMisses += 1
+    spacing = source['spacing']
+    origin = source['origin']
+    if roiExtent is not None:
+      origin = [origin[i] + roiExtent[2 * i] * spacing[i] for i in range(3)]
+    segmentationRun.pendingExport = {'nodeID': source['cacheEntry'], 'cacheKey': cacheKey, 'fileName': source['fileName'],
+                                     'format': 'raw', 'array': source['array'], 'imageData': source['imageData'],
+                                     'roiExtent': roiExtent, 'spacing': spacing, 'origin': origin}
+
+  def segmentSeeds(self, segmentationRun):
+    """Segments every seed of a run with its backend and returns the results, one NEEDLE_RESULT line per seed.
+    All seeds share the exported image. They are segmented one after the other by the worker
+    when it is used, in parallel (one-shot calls or in-process backend) otherwise.
+    """
+    backend = segmentationRun.backend
+    seedPoints = segmentationRun.seedPoints
+    if len(seedPoints) == 1 or (backend.exportsImage and segmentationRun.useWorker and self.startWorker()):
+      outputs = []
+      for seedPoint in seedPoints:
+        if segmentationRun.cancelled:
+          break
+        outputs.append(backend.segment(self, segmentationRun, seedPoint))
+    else:
+      pool = multiprocessing.pool.ThreadPool(min(len(seedPoints), multiprocessing.cpu_count()))
+      try:
+        outputs = pool.map(lambda seedPoint: backend.segment(self, segmentationRun, seedPoint), seedPoints)
+      finally:
+        pool.close()
+        pool.join()
+    results = []
+    for output in outputs:
+      parsedResults = self.parseResults(output)
+      if not parsedResults:
+        raise ValueError('No result in the segmentation output: ' + output)
+      results.append(parsedResults[0])
+    return '\n'.join(result.toMessage() for result in results)
+
+  def parseResults(self, output):
+    """Returns the StaticNeedleSegmentationResult list read from the output of a segmentation
+    """
+    parser = StaticNeedleSegmentationResultParser()
+    parser.feed(output)
+    results = parser.close()
+    if parser.errors:
+      raise StaticNeedleSegmentationError('Segmentation reported: ' + parser.errors[0])
+    return results
+
+  def getResultPoints(self, segmentationRun):
+    """Returns the tip and tail found by the algorithm, in RAS coordinates
+    """
+    return self.getResultPointsList(segmentationRun)[0]
 
-    tip = tip[:3]
-    tail = tail[:3]
+  def getResultPointsList(self, segmentationRun):
+    """Returns the tip and tail found by the algorithm for each seed, in RAS coordinates
+    """
+    return [(result.tip, result.tail) for result in self.getResults(segmentationRun)]
 
+  def getResults(self, segmentationRun):
+    """Returns the StaticNeedleSegmentationResult of each seed, in RAS coordinates
+    """
+    # The cropped image keeps the physical coordinates of the full volume (see prepareExport),
+    # so results from a ROI run map back to the full volume like those of a full run
+    with segmentationRun.report.timeStage('outputParsing'):
+      results = self.parseResults(segmentationRun.outputFromExe)
+    if not results:
+      raise ValueError('Unexpected output from the segmentation: ' + segmentationRun.outputFromExe)
+    report = segmentationRun.report
+    report.confidences = [result.confidence for result in results]
+    report.algorithmSeconds = collections.OrderedDict()
+    for result in results:
+      for stageName, seconds in result.timings.items():
+        report.algorithmSeconds[stageName] = report.algorithmSeconds.get(stageName, 0.0) + seconds
+    # undo the direction conversion and reapply the transform (if present) to the output points
+    return [result.mapPoints(segmentationRun.volumeTransform.imageToWorld) for result in results]
+
+  def finishRun(self, segmentationRun, outputPoints, manSegPoints, insertAngle, enableNeedleModels, enableScreenshots=0):
+    """Last stage of a run, must be called on the main thread: imports the
+    algorithm results into the scene.
+    """
+    segmentationRun.stage = 'import'
 
-    outputPoints.AddFiducialFromArray(tip)
-    outputPoints.AddFiducialFromArray(tail)
+    #Pass results of algorithm to output markups fiducial
+    #A multi-seed run outputs a tip and a tail per seed, in the order of the seeds, labelled with the seed index
+    report = segmentationRun.report
+    self.lastResults = self.getResults(segmentationRun)
+    needles = [(result.tip, result.tail) for result in self.lastResults]
+    with report.timeStage('fiducialUpdate'):
+      outputPoints.RemoveAllMarkups()
+      for seedIndex, (tip, tail) in enumerate(needles):
+        tipIndex = outputPoints.AddFiducialFromArray(tip)
+        tailIndex = outputPoints.AddFiducialFromArray(tail)
+        if segmentationRun.multiSeed:
+          outputPoints.SetNthFiducialLabel(tipIndex, 'Tip {0}'.format(seedIndex + 1))
+          outputPoints.SetNthFiducialLabel(tailIndex, 'Tail {0}'.format(seedIndex + 1))
+    tip, tail = needles[0]
 
     #Compare algorithm results to manually selected fiducials
     ####
     #Check whether or not a manually selected tip has been input
     if manSegPoints is None or manSegPoints.GetNumberOfFiducials() == 0:
       print('No manually selected tip.')
+    elif segmentationRun.multiSeed:
+      #One manually selected tip per seed, in the same order
+      if manSegPoints.GetNumberOfFiducials() != len(needles):
+        print('Number of manually selected tips does not match the number of seeds.')
+      else:
+        with report.timeStage('metrics'):
+          manualTips = []
+          for index in range(len(needles)):
+            manualTip = [0.0, 0.0, 0.0]
+            manSegPoints.GetNthFiducialPosition(index, manualTip)
+            manualTips.append(manualTip)
+          self.addMetricsRows(self.computeMetricsArray([needle[0] for needle in needles], [needle[1] for needle in needles],
+                                                       manualTips, insertAngle), metadata=self.getRunMetadata(segmentationRun))
     else:
-      self.compareToManualSeg(tip, tail, manSegPoints, insertAngle)
+      with report.timeStage('metrics'):
+        self.compareToManualSeg(tip, tail, manSegPoints, insertAngle, self.getRunMetadata(segmentationRun))
     ####
 
-    #Extrapolate points on needle to extent of image volume
-
-
-    #Generate model of needle from points (radius of 1mm)
+    if enableNeedleModels:
+      with report.timeStage('needleModels'):
+        #Extrapolate points on needle to extent of image volume
+        shaftEnds = self.extrapolateToBounds([needle[0] for needle in needles], [needle[1] for needle in needles],
+                                             segmentationRun.volumeBounds)
 
+        #Generate model of needle from points (radius of 1mm)
+        self.updateNeedleModels(outputPoints, [needle[0] for needle in needles], shaftEnds)
 
     # Capture screenshot
     if enableScreenshots:
-      self.takeScreenshot('StaticNeedleSegmentationTest-Start','MyScreenshot',-1)
+      with report.timeStage('screenshot'):
+        self.takeScreenshot('StaticNeedleSegmentationTest-Start','MyScreenshot',-1)
+
+    segmentationRun.stage = 'done'
 
+  def getSeedPoint(self, inputSeed):
+    """Returns the seed point in RAS coordinates: the first point of a markups fiducial node,
+    or inputSeed itself if it is a sequence of three coordinates
+    """
+    if hasattr(inputSeed, 'GetNthFiducialPosition'):
+      #Get seed point
+      seedPoint_slicer = [0.0, 0.0, 0.0]  # seedPoint in RAS coordinates of slicer
+      inputSeed.GetNthFiducialPosition(0, seedPoint_slicer)
+      return seedPoint_slicer
+    return [float(c) for c in inputSeed[:3]]
+
+  def extrapolateToBounds(self, tips, tails, bounds):
+    """Returns where the needles leave the box bounds (xmin, xmax, ymin, ymax, zmin, zmax), following
+    each line from the tip through the tail. tips and tails are Nx3 arrays. Tails beyond the box are kept.
+    """
+    tips = numpy.asarray(tips, dtype=float).reshape(-1, 3)
+    directions = numpy.asarray(tails, dtype=float).reshape(-1, 3) - tips
+    lower = numpy.array(bounds[0::2], dtype=float)
+    upper = numpy.array(bounds[1::2], dtype=float)
+    # distance to the far plane of each slab, in multiples of the tip to tail vector
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+      farPlanes = numpy.maximum((lower - tips) / directions, (upper - tips) / directions)
+    farPlanes[directions == 0] = numpy.inf
+    exits = farPlanes.min(axis=1)
+    exits[~numpy.isfinite(exits)] = 1.0
+    return tips + numpy.maximum(exits, 1.0)[:, numpy.newaxis] * directions
+
+  def updateNeedleModels(self, outputPoints, tips, shaftEnds):
+    """Shows a tube of needleModelRadius from each tip to its shaft end. The models of outputPoints
+    created by earlier runs are updated in place, models of needles that are no longer found are removed.
+    """
+    for index, (tip, shaftEnd) in enumerate(zip(tips, shaftEnds)):
+      key = (outputPoints.GetID(), index)
+      entry = self.needleModels.get(key)
+      if entry is None or slicer.mrmlScene.GetNodeByID(entry[0]) is None:
+        lineSource = vtk.vtkLineSource()
+        tubeFilter = vtk.vtkTubeFilter()
+        tubeFilter.SetInputConnection(lineSource.GetOutputPort())
+        tubeFilter.SetNumberOfSides(12)
+        tubeFilter.CappingOn()
+        modelNode = slicer.vtkMRMLModelNode()
+        modelNode.SetName(slicer.mrmlScene.GenerateUniqueName(outputPoints.GetName() + '-Needle'))
+        slicer.mrmlScene.AddNode(modelNode)
+        modelNode.CreateDefaultDisplayNodes()
+        modelNode.SetPolyDataConnection(tubeFilter.GetOutputPort())
+        entry = (modelNode.GetID(), lineSource, tubeFilter)
+        self.needleModels[key] = entry
+      modelNodeID, lineSource, tubeFilter = entry
+      lineSource.SetPoint1(tip[0], tip[1], tip[2])
+      lineSource.SetPoint2(shaftEnd[0], shaftEnd[1], shaftEnd[2])
+      tubeFilter.SetRadius(self.needleModelRadius)
+      tubeFilter.Update()
+
+    for key in [key for key in self.needleModels if key[0] == outputPoints.GetID() and key[1] >= len(tips)]:
+      modelNode = slicer.mrmlScene.GetNodeByID(self.needleModels.pop(key)[0])
+      if modelNode is not None:
+        slicer.mrmlScene.RemoveNode(modelNode)
+
+  def getSeedPoints(self, inputSeed):
+    """Returns the seed points in RAS coordinates: all points of a markups fiducial node,
+    or inputSeed itself if it is a list of points
+    """
+    if hasattr(inputSeed, 'GetNthFiducialPosition'):
+      seedPoints = []
+      for index in range(inputSeed.GetNumberOfFiducials()):
+        seedPoint_slicer = [0.0, 0.0, 0.0]
+        inputSeed.GetNthFiducialPosition(index, seedPoint_slicer)
+        seedPoints.append(seedPoint_slicer)
+      return seedPoints
+    return [[float(c) for c in seedPoint[:3]] for seedPoint in inputSeed]
+
+  def finishRunReport(self, segmentationRun, error=None):
+    """Completes the report of a run, keeps it as lastRunReport and appends it to runReportFileName if set
+    """
+    report = segmentationRun.report
+    report.error = error
+    report.finish()
+    self.lastRunReport = report
+    logging.info(str(report))
+    if self.runReportFileName:
+      with open(self.runReportFileName, 'a') as reportFile:
+        reportFile.write(report.toJson() + '\n')
+    return report
+
+  def run(self, inputVolume, inputSeedFiducial, outputPoints, manSegPoints, insertAngle, enableNeedleModels,enableScreenshots=0, enableRoi=False,
+          roiPoints=None, backend=None, multiSeed=False, pyramid=False):
+    """
+    Run the actual algorithm
+    If pyramid is set, a downsampled image is segmented first and refined at full resolution around the result
+    If multiSeed is set, a needle is segmented for every point of inputSeedFiducial, from a single exported image
+    If enableRoi is set, only a region of roiLength around the seed is segmented
+    If roiPoints are given, only a region of reseedMargin around them is segmented
+    backend is the name of the segmentation backend (see backends), the default backend if None
+    Returns a StaticNeedleSegmentationRunReport with the duration of each stage
+    """
+
+    # if not self.isValidInputOutputData(inputVolume, outputVolume):
+    #   slicer.util.errorDisplay('Input volume is the same as output volume. Choose a different output volume.')
+    #   return False
+
+    logging.info('Processing started')
+    self.cancelRequested = False
+    seedPoint_slicer = self.getSeedPoints(inputSeedFiducial) if multiSeed else self.getSeedPoint(inputSeedFiducial)
+    segmentationRun = self.prepareRun(inputVolume, seedPoint_slicer, insertAngle, enableRoi, roiPoints, backend, pyramid)
+    try:
+      self.executeRun(segmentationRun)
+      self.finishRun(segmentationRun, outputPoints, manSegPoints, insertAngle, enableNeedleModels, enableScreenshots)
+    except Exception as e:
+      self.finishRunReport(segmentationRun, str(e))
+      raise
+    finally:
+      self.releaseRun(segmentationRun)
     logging.info('Processing completed')
 
-    return True
+    return self.finishRunReport(segmentationRun)
+
+  def runAsync(self, inputVolume, inputSeedFiducial, outputPoints, manSegPoints, insertAngle, enableNeedleModels,
+               enableScreenshots=0, enableRoi=False, progressCallback=None, finishedCallback=None, roiPoints=None,
+               backend=None, multiSeed=False, pyramid=False, liveVolume=False):
+    """Same as run, but returns immediately. The image write and the segmentation
+    run in a worker thread, the results are imported on the main thread when it completes.
+    liveVolume is set for volumes updated continuously, see prepareRun.
+    progressCallback(stage, percent) is called when a new stage (export, segment, import) starts.
+    finishedCallback(success, errorMessage) is called when the run completes, fails or is cancelled.
+    """
+    if self.isRunning():
+      raise RuntimeError('A segmentation is already running')
+
+    logging.info('Processing started')
+    self.cancelRequested = False
+    seedPoint_slicer = self.getSeedPoints(inputSeedFiducial) if multiSeed else self.getSeedPoint(inputSeedFiducial)
+    segmentationRun = self.prepareRun(inputVolume, seedPoint_slicer, insertAngle, enableRoi, roiPoints, backend, pyramid,
+                                      liveVolume)
+    segmentationRun.finishArguments = (outputPoints, manSegPoints, insertAngle, enableNeedleModels, enableScreenshots)
+    segmentationRun.progressCallback = progressCallback
+    segmentationRun.finishedCallback = finishedCallback
+    self.asyncRun = segmentationRun
+    self.reportAsyncProgress(segmentationRun)
+
+    segmentationRun.thread = threading.Thread(target=self.executeRunInThread, args=(segmentationRun,))
+    segmentationRun.thread.daemon = True
+    segmentationRun.thread.start()
+
+    # Poll the worker thread from the main thread, so that callbacks and scene updates happen there
+    self.asyncRunTimer = qt.QTimer()
+    self.asyncRunTimer.setInterval(50)
+    self.asyncRunTimer.connect('timeout()', self.onAsyncRunTimer)
+    self.asyncRunTimer.start()
+    return segmentationRun
+
+  def executeRunInThread(self, segmentationRun):
+    try:
+      self.executeRun(segmentationRun)
+    except Exception as e:
+      segmentationRun.error = str(e)
+
+  def isRunning(self):
+    return self.asyncRun is not None
+
+  def cancelRun(self):
+    """Cancels the running asynchronous segmentation by killing the segmentation process
+    """
+    if self.asyncRun is None:
+      return
+    logging.info('Cancelling segmentation')
+    self.cancelRequested = True
+    self.asyncRun.cancelled = True
+    for activeProcess in list(self.activeProcesses):
+      if activeProcess.poll() is None:
+        activeProcess.kill()
+    if self.worker is not None and self.worker.isRunning():
+      self.worker.process.kill()
+
+  def startTracking(self, inputVolume, inputSeedFiducial, outputPoints, insertAngle, enableRoi=False, statusCallback=None):
+    """Segments inputVolume now and again every time its image data is modified, e.g. by OpenIGTLink.
+    See StaticNeedleSegmentationTracker.
+    """
+    self.stopTracking()
+    self.tracker = StaticNeedleSegmentationTracker(self, inputVolume, inputSeedFiducial, outputPoints, insertAngle,
+                                                   enableRoi, statusCallback)
+    self.tracker.start()
+    return self.tracker
+
+  def stopTracking(self):
+    if self.tracker is not None:
+      self.tracker.stop()
+      self.tracker = None
+
+  def isTracking(self):
+    return self.tracker is not None
+
+  def startSeedWatching(self, inputVolume, inputSeedFiducial, outputPoints, manSegPoints, insertAngle,
+                        enableNeedleModels=False, statusCallback=None):
+    """Updates the segmentation of inputVolume every time inputSeedFiducial is moved.
+    See StaticNeedleSegmentationSeedWatcher.
+    """
+    self.stopSeedWatching()
+    self.seedWatcher = StaticNeedleSegmentationSeedWatcher(self, inputVolume, inputSeedFiducial, outputPoints, manSegPoints,
+                                                           insertAngle, enableNeedleModels, statusCallback)
+    self.seedWatcher.start()
+    return self.seedWatcher
+
+  def stopSeedWatching(self):
+    if self.seedWatcher is not None:
+      self.seedWatcher.stop()
+      self.seedWatcher = None
+
+  def isWatchingSeed(self):
+    return self.seedWatcher is not None
+
+  def reportAsyncProgress(self, segmentationRun):
+    stage = segmentationRun.stage
+    if stage == segmentationRun.reportedStage:
+      return
+    segmentationRun.reportedStage = stage
+    if segmentationRun.progressCallback:
+      segmentationRun.progressCallback(stage, self.runStageProgress.get(stage, 0))
+
+  def onAsyncRunTimer(self):
+    segmentationRun = self.asyncRun
+    if segmentationRun is None:
+      self.asyncRunTimer.stop()
+      return
+    self.reportAsyncProgress(segmentationRun)
+    if segmentationRun.thread.is_alive():
+      return
+
+    self.asyncRunTimer.stop()
+    self.asyncRun = None
+    if self.worker is not None and not self.worker.isRunning():
+      # killed by cancelRun
+      self.stopWorker()
+
+    errorMessage = None
+    if segmentationRun.cancelled:
+      errorMessage = 'Segmentation cancelled'
+    elif segmentationRun.error is not None:
+      errorMessage = segmentationRun.error
+    else:
+      try:
+        segmentationRun.stage = 'import'
+        self.reportAsyncProgress(segmentationRun)
+        self.finishRun(segmentationRun, *segmentationRun.finishArguments)
+        self.reportAsyncProgress(segmentationRun)
+      except Exception as e:
+        errorMessage = str(e)
+    self.releaseRun(segmentationRun)
+    self.finishRunReport(segmentationRun, errorMessage)
+
+    if errorMessage is None:
+      logging.info('Processing completed')
+    else:
+      logging.error('Processing failed: ' + errorMessage)
+    if segmentationRun.finishedCallback:
+      segmentationRun.finishedCallback(errorMessage is None, errorMessage)
+
+  # Columns of batch manifests, seed and manual tip in RAS coordinates
+  batchManifestColumns = ['volume', 'seedR', 'seedA', 'seedS', 'manualTipR', 'manualTipA', 'manualTipS', 'insertAngle']
+  batchResultColumns = ['volume', 'seedR', 'seedA', 'seedS', 'tipR', 'tipA', 'tipS', 'tailR', 'tailA', 'tailS'] + \
+    metricsColumnNames + ['error']
+
+  def readBatchManifest(self, manifestFileName):
+    """Reads a CSV manifest with the batchManifestColumns header, one segmentation per row.
+    The manual tip and insertion angle columns may be empty. Relative volume paths are
+    resolved against the manifest directory.
+    Returns a list of dictionaries with volume, seed, manualTip (or None) and insertAngle keys.
+    """
+    manifestDirectory = os.path.dirname(os.path.abspath(manifestFileName))
+    rows = []
+    with openCsvFile(manifestFileName) as manifestFile:
+      for record in csv.DictReader(manifestFile):
+        row = {}
+        row['volume'] = os.path.join(manifestDirectory, record['volume'].strip())
+        row['seed'] = [float(record[column]) for column in ['seedR', 'seedA', 'seedS']]
+        manualTip = [(record.get(column) or '').strip() for column in ['manualTipR', 'manualTipA', 'manualTipS']]
+        row['manualTip'] = [float(c) for c in manualTip] if all(manualTip) else None
+        insertAngle = (record.get('insertAngle') or '').strip()
+        row['insertAngle'] = float(insertAngle) if insertAngle else 45.0
+        rows.append(row)
+    return rows
+
+  def runBatch(self, manifestRows, numberOfWorkers=None, resultsFileName=None, enableRoi=False, resultCallback=None):
+    """Segments every row of a manifest (see readBatchManifest) without any user interface.
+    Volumes are loaded and released one by one on the calling thread, while up to numberOfWorkers
+    (default: number of CPUs) segmentation processes run in parallel, each in its own temporary directory.
+    As each segmentation completes, its metrics are added to the Metrics table (if a manual tip is given,
+    in batches of metricsSink.maximumBufferedRows), a row is appended to the resultsFileName CSV file and resultCallback(result) is called.
+    Returns the list of results, dictionaries with the batchResultColumns keys, in completion order.
+    """
+    if numberOfWorkers is None:
+      numberOfWorkers = multiprocessing.cpu_count()
+    numberOfWorkers = max(1, int(numberOfWorkers))
+    self.cancelRequested = False
+
+    resultsFile = None
+    resultsWriter = None
+    if resultsFileName:
+      resultsFile = openCsvFile(resultsFileName, 'w')
+      resultsWriter = csv.DictWriter(resultsFile, fieldnames=self.batchResultColumns)
+      resultsWriter.writeheader()
+      resultsFile.flush()
+
+    results = []
+    pendingJobs = []
+    pool = multiprocessing.pool.ThreadPool(numberOfWorkers)
+    try:
+      rowIterator = iter(manifestRows)
+      rowsRemaining = True
+      while rowsRemaining or pendingJobs:
+        # Keep every worker busy, with at most one loaded volume waiting per worker
+        while rowsRemaining and len(pendingJobs) < 2 * numberOfWorkers and not self.cancelRequested:
+          try:
+            row = next(rowIterator)
+          except StopIteration:
+            rowsRemaining = False
+            break
+          pendingJobs.append(self.startBatchJob(pool, row, enableRoi))
+        if self.cancelRequested:
+          rowsRemaining = False
+
+        finishedJobs = [job for job in pendingJobs if job['asyncResult'] is None or job['asyncResult'].ready()]
+        if not finishedJobs:
+          time.sleep(0.01)
+          continue
+        for job in finishedJobs:
+          pendingJobs.remove(job)
+          result = self.finishBatchJob(job)
+          results.append(result)
+          if resultsWriter is not None:
+            resultsWriter.writerow(result)
+            resultsFile.flush()
+          if resultCallback is not None:
+            resultCallback(result)
+    finally:
+      pool.close()
+      pool.join()
+      for job in pendingJobs:
+        self.releaseBatchJob(job)
+      if resultsFile is not None:
+        resultsFile.close()
+      self.metricsSink.flush()
+    return results
+
+  def startBatchJob(self, pool, row, enableRoi):
+    """Loads the volume of a manifest row and submits its segmentation to the pool
+    """
+    job = {'row': row, 'volumeNode': None, 'segmentationRun': None,
+           'asyncResult': None, 'error': None}
+    try:
+      success, volumeNode = slicer.util.loadVolume(row['volume'], returnNode=True)
+      if not success:
+        raise IOError('Failed to load volume ' + row['volume'])
+      job['volumeNode'] = volumeNode
+      segmentationRun = self.prepareRun(volumeNode, row['seed'], row['insertAngle'], enableRoi)
+      segmentationRun.useWorker = False
+      job['segmentationRun'] = segmentationRun
+      job['asyncResult'] = pool.apply_async(self.executeRunInThread, (segmentationRun,))
+    except Exception as e:
+      job['error'] = str(e)
+    return job
+
+  def finishBatchJob(self, job):
+    """Computes the results of a completed batch job and releases its volume and files
+    """
+    row = job['row']
+    result = dict.fromkeys(self.batchResultColumns, '')
+    result['volume'] = row['volume']
+    result['seedR'], result['seedA'], result['seedS'] = row['seed']
+    segmentationRun = job['segmentationRun']
+    error = job['error']
+    if error is None and segmentationRun is not None:
+      error = segmentationRun.error
+    try:
+      if error is None:
+        tip, tail = self.getResultPoints(segmentationRun)
+        result['tipR'], result['tipA'], result['tipS'] = tip
+        result['tailR'], result['tailA'], result['tailS'] = tail
+        if row['manualTip'] is not None:
+          metrics = self.computeMetrics(tip, tail, row['manualTip'], row['insertAngle'])
+          for columnName, value in zip(self.metricsColumnNames, metrics):
+            result[columnName] = value
+          self.addMetricsRow(metrics, self.getRunMetadata(segmentationRun), flush=False)
+    except Exception as e:
+      error = str(e)
+    if error is not None:
+      logging.error('Segmentation of ' + row['volume'] + ' failed: ' + error)
+      result['error'] = error
+    if segmentationRun is not None:
+      self.finishRunReport(segmentationRun, error)
+    self.releaseBatchJob(job)
+    return result
+
+  def releaseBatchJob(self, job):
+    if job['segmentationRun'] is not None:
+      self.releaseRun(job['segmentationRun'])
+    volumeNode = job['volumeNode']
+    if volumeNode is not None:
+      self.releaseVolume(volumeNode.GetID())
+      slicer.mrmlScene.RemoveNode(volumeNode)
+      job['volumeNode'] = None
 
 
 class StaticNeedleSegmentationTest(ScriptedLoadableModuleTest):
@@ -471,6 +2863,12 @@ class StaticNeedleSegmentationTest(ScriptedLoadableModuleTest):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  # Synthetic needle volumes (see createNeedleVolume): voxel spacing (mm) and needle
+  # end points, as fractions of the volume size along i, j, k
+  needleVolumeSpacing = 0.5
+  needleTailFraction = [0.5, 0.85, 0.2]
+  needleTipFraction = [0.5, 0.2, 0.65]
+
   def setUp(self):
     """ Do whatever is needed to reset the state - typically a scene clear will be enough.
     """
@@ -481,6 +2879,30 @@ class StaticNeedleSegmentationTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_StaticNeedleSegmentation1()
+    self.setUp()
+    self.test_ExportCache()
+    self.setUp()
+    self.test_RawExport()
+    self.setUp()
+    self.test_MetricsArray()
+    self.setUp()
+    self.test_ReseedRegion()
+    self.setUp()
+    self.test_NeedleModels()
+    self.setUp()
+    self.test_VolumeTransform()
+    self.setUp()
+    self.test_ResultParser()
+    self.setUp()
+    self.test_MetricsSink()
+    self.setUp()
+    self.test_BatchRelease()
+    self.setUp()
+    self.test_Tracker()
+    self.setUp()
+    self.test_ResultCache()
+    self.setUp()
+    self.test_NumpyBackend()
 
   def test_StaticNeedleSegmentation1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -517,3 +2939,480 @@ class StaticNeedleSegmentationTest(ScriptedLoadableModuleTest):
     logic = StaticNeedleSegmentationLogic()
     self.assertIsNotNone( logic.hasImageData(volumeNode) )
     self.delayDisplay('Test passed!')
+
+  def test_ExportCache(self):
+    """ Exporting an unchanged volume twice should reuse the file written the first time.
+    """
+    self.delayDisplay("Starting the export cache test")
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(10, 10, 10)
+    imageData.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+    volumeNode = slicer.vtkMRMLScalarVolumeNode()
+    volumeNode.SetAndObserveImageData(imageData)
+    slicer.mrmlScene.AddNode(volumeNode)
+
+    logic = StaticNeedleSegmentationLogic()
+    fileName = os.path.join(slicer.app.temporaryPath, 'StaticNeedleSegmentationExportCacheTest.mha')
+    self.assertTrue(logic.exportInputVolume(volumeNode, fileName))
+    self.assertFalse(logic.exportInputVolume(volumeNode, fileName))
+    self.assertEqual(logic.getExportCacheStatistics(), {'hits': 1, 'misses': 1})
+
+    # Modifying the image or the geometry must trigger a new export
+    imageData.Modified()
+    self.assertTrue(logic.exportInputVolume(volumeNode, fileName))
+    volumeNode.SetSpacing(0.5, 0.5, 0.5)
+    self.assertTrue(logic.exportInputVolume(volumeNode, fileName))
+    self.assertEqual(logic.getExportCacheStatistics(), {'hits': 1, 'misses': 3})
+
+    # Exporting a region keeps the whole volume file, which is deleted with the volume
+    roiFileName = os.path.join(slicer.app.temporaryPath, 'StaticNeedleSegmentationExportCacheTestRoi.mha')
+    self.assertTrue(logic.exportInputVolume(volumeNode, roiFileName, [0, 4, 0, 4, 0, 4]))
+    self.assertFalse(logic.exportInputVolume(volumeNode, fileName))
+    slicer.mrmlScene.RemoveNode(volumeNode)
+    self.assertFalse(os.path.exists(fileName))
+    self.assertEqual(logic.exportCache, {})
+    logic.cleanup()
+    self.delayDisplay('Test passed!')
+
+  def test_RawExport(self):
+    """ Raw exports of a whole volume and of a region should be read back by VTK with the same voxels and geometry.
+    """
+    self.delayDisplay("Starting the raw export test")
+    voxels = numpy.arange(6 * 7 * 8, dtype=numpy.uint16).reshape(6, 7, 8)
+    volumeNode = slicer.vtkMRMLScalarVolumeNode()
+    volumeNode.SetSpacing(0.5, 0.6, 0.7)
+    volumeNode.SetOrigin(1.0, 2.0, 3.0)
+    slicer.mrmlScene.AddNode(volumeNode)
+    slicer.util.updateVolumeFromArray(volumeNode, voxels)
+
+    logic = StaticNeedleSegmentationLogic()
+    logic.exportFormat = 'raw'
+    temporaryDirectory = tempfile.mkdtemp(prefix='StaticNeedleSegmentationTest-')
+    try:
+      fileName = os.path.join(temporaryDirectory, 'export.mhd')
+      # the region is not contiguous in memory, it is written one slice at a time
+      for roiExtent in [None, [1, 5, 2, 4, 0, 3]]:
+        logic.clearExportCache()
+        self.assertTrue(logic.exportInputVolume(volumeNode, fileName, roiExtent))
+        reader = vtk.vtkMetaImageReader()
+        reader.SetFileName(fileName)
+        reader.Update()
+        image = reader.GetOutput()
+        dimensions = image.GetDimensions()
+        exported = numpy_support.vtk_to_numpy(image.GetPointData().GetScalars()).reshape(dimensions[2], dimensions[1], dimensions[0])
+        expected = voxels
+        expectedOrigin = numpy.array([1.0, 2.0, 3.0])
+        if roiExtent is not None:
+          expected = voxels[roiExtent[4]:roiExtent[5] + 1, roiExtent[2]:roiExtent[3] + 1, roiExtent[0]:roiExtent[1] + 1]
+          expectedOrigin += numpy.array(roiExtent[0::2]) * [0.5, 0.6, 0.7]
+        numpy.testing.assert_array_equal(exported, expected)
+        numpy.testing.assert_allclose(image.GetSpacing(), [0.5, 0.6, 0.7])
+        numpy.testing.assert_allclose(image.GetOrigin(), expectedOrigin)
+
+      # a volume modified before its export is written is exported again by the next run
+      pendingExport = logic.prepareExport(volumeNode, fileName)
+      volumeNode.GetImageData().Modified()
+      logic.writeExport(pendingExport)
+      self.assertIsNotNone(logic.prepareExport(volumeNode, fileName))
+    finally:
+      logic.cleanup()
+      shutil.rmtree(temporaryDirectory, ignore_errors=True)
+    self.delayDisplay('Test passed!')
+
+  def test_MetricsArray(self):
+    """ Vectorized metrics should match the per-needle metrics and fill numeric table columns.
+    """
+    self.delayDisplay("Starting the metrics test")
+    logic = StaticNeedleSegmentationLogic()
+    tips = numpy.array([[0.0, -10.0, 0.0], [1.0, -20.0, 3.0], [5.0, -5.0, 2.0]])
+    tails = numpy.array([[0.0, 0.0, 0.0], [0.0, 0.0, 0.0], [-1.0, 2.0, 0.0]])
+    manualTips = numpy.array([[0.0, -10.0, 0.0], [0.0, -18.0, 2.0], [4.0, -6.0, 3.0]])
+    metrics = logic.computeMetricsArray(tips, tails, manualTips, 45.0)
+    self.assertEqual(metrics.shape, (3, 5))
+
+    # a perfect segmentation along the A-P axis
+    numpy.testing.assert_allclose(metrics[0], [0.0, 0.0, 0.0, 0.0, 45.0], atol=1e-6)
+    for row in range(3):
+      numpy.testing.assert_allclose(metrics[row], logic.computeMetrics(tips[row], tails[row], manualTips[row], 45.0))
+
+    logic.addMetricsRows(metrics)
+    tableNode = logic.getMetricsTable()
+    self.assertEqual(tableNode.GetNumberOfRows(), 3)
+    self.assertTrue(isinstance(tableNode.GetTable().GetColumn(0), vtk.vtkDoubleArray))
+    self.assertAlmostEqual(tableNode.GetTable().GetValue(2, 4).ToDouble(), metrics[2, 4])
+    self.delayDisplay('Test passed!')
+
+  def test_MetricsSink(self):
+    """ Buffered metrics should reach the table and the CSV file together, with their metadata.
+    """
+    self.delayDisplay("Starting the metrics sink test")
+    logic = StaticNeedleSegmentationLogic()
+    temporaryDirectory = tempfile.mkdtemp(prefix='StaticNeedleSegmentationTest-')
+    try:
+      sink = logic.metricsSink
+      sink.fileName = os.path.join(temporaryDirectory, 'metrics.csv')
+      metrics = logic.computeMetricsArray([[0.0, -10.0, 0.0], [1.0, -20.0, 3.0]], [[0.0, 0.0, 0.0]] * 2,
+                                          [[0.0, -9.0, 0.0], [0.0, -18.0, 2.0]], 45.0)
+      logic.addMetricsRows(metrics, metadata={'volumeName': 'Volume1', 'seedPoints': [[0.0, -5.0, 0.0], [0.5, -10.0, 1.5]],
+                                              'backendName': 'numpy', 'build': 'test'}, flush=False)
+      self.assertFalse(os.path.exists(sink.fileName))
+      tableNode = logic.getMetricsTable()
+      table = tableNode.GetTable()
+      self.assertEqual(table.GetNumberOfRows(), 2)
+      self.assertEqual(table.GetColumnByName('Volume').GetValue(1), 'Volume1')
+      self.assertAlmostEqual(table.GetColumnByName('Seed A').GetValue(1), -10.0)
+
+      # rows go to a new table once the table is removed from the scene, and are appended to the file
+      slicer.mrmlScene.RemoveNode(tableNode)
+      logic.addMetricsRow(metrics[0])
+      self.assertEqual(logic.getMetricsTable().GetNumberOfRows(), 1)
+      with openCsvFile(sink.fileName) as metricsFile:
+        rows = list(csv.DictReader(metricsFile))
+      self.assertEqual(len(rows), 3)
+      self.assertEqual(rows[0]['Backend'], 'numpy')
+      self.assertAlmostEqual(float(rows[1][logic.metricsColumnNames[0]]), metrics[1, 0])
+    finally:
+      shutil.rmtree(temporaryDirectory, ignore_errors=True)
+    self.delayDisplay('Test passed!')
+
+  def test_BatchRelease(self):
+    """ Nothing of the volumes of a batch should be kept once it has completed.
+    """
+    self.delayDisplay("Starting the batch release test")
+    logic = StaticNeedleSegmentationLogic()
+    logic.backendName = 'numpy'
+    temporaryDirectory = tempfile.mkdtemp(prefix='StaticNeedleSegmentationTest-')
+    try:
+      manifestRows = []
+      for index in range(2):
+        volumeNode, tip, tail = self.createNeedleVolume(32)
+        fileName = os.path.join(temporaryDirectory, 'volume{0}.nrrd'.format(index))
+        slicer.util.saveNode(volumeNode, fileName)
+        slicer.mrmlScene.RemoveNode(volumeNode)
+        manifestRows.append({'volume': fileName, 'seed': list((tip + tail) / 2.0), 'manualTip': list(tip),
+                             'insertAngle': self.getInsertAngle(tip, tail)})
+      results = logic.runBatch(manifestRows, 2)
+      self.assertEqual([result['error'] for result in results], ['', ''])
+      self.assertEqual(logic.volumeTransforms, {})
+      self.assertEqual(logic.volumeHashes, {})
+
+      # volumes removed by the user are released too
+      volumeNode, tip, tail = self.createNeedleVolume(32)
+      outputNode = slicer.vtkMRMLMarkupsFiducialNode()
+      slicer.mrmlScene.AddNode(outputNode)
+      seedNode = slicer.vtkMRMLMarkupsFiducialNode()
+      slicer.mrmlScene.AddNode(seedNode)
+      seedNode.AddFiducialFromArray(list((tip + tail) / 2.0))
+      logic.run(volumeNode, seedNode, outputNode, None, self.getInsertAngle(tip, tail), False)
+      self.assertIn(volumeNode.GetID(), logic.volumeTransforms)
+      slicer.mrmlScene.RemoveNode(volumeNode)
+      self.assertEqual(logic.volumeTransforms, {})
+      self.assertEqual(logic.volumeHashes, {})
+    finally:
+      logic.cleanup()
+      shutil.rmtree(temporaryDirectory, ignore_errors=True)
+    self.delayDisplay('Test passed!')
+
+  def test_Tracker(self):
+    """ Bursts of image updates should be segmented once, without hashing or caching the frames.
+    """
+    self.delayDisplay("Starting the tracker test")
+    logic = StaticNeedleSegmentationLogic()
+    logic.backendName = 'numpy'
+    volumeNode, tip, tail = self.createNeedleVolume(32)
+    seedNode = slicer.vtkMRMLMarkupsFiducialNode()
+    slicer.mrmlScene.AddNode(seedNode)
+    seedNode.AddFiducialFromArray(list((tip + tail) / 2.0))
+    outputNode = slicer.vtkMRMLMarkupsFiducialNode()
+    slicer.mrmlScene.AddNode(outputNode)
+    try:
+      tracker = logic.startTracking(volumeNode, seedNode, outputNode, self.getInsertAngle(tip, tail))
+      for frame in range(4):
+        volumeNode.GetImageData().Modified()
+      self.waitForTracker(tracker, 1)
+      self.assertEqual(tracker.framesFailed, 0)
+      self.assertEqual(tracker.framesReceived, tracker.framesSegmented + tracker.getFramesDropped())
+      self.assertGreater(tracker.getFramesDropped(), 0)
+      self.assertEqual(outputNode.GetNumberOfFiducials(), 2)
+
+      # a frame arriving after the debounce interval is segmented on its own
+      volumeNode.GetImageData().Modified()
+      self.waitForTracker(tracker, 2)
+      self.assertEqual(logic.getResultCacheStatistics()['hits'] + logic.getResultCacheStatistics()['misses'], 0)
+      self.assertEqual(logic.volumeHashes, {})
+    finally:
+      logic.cleanup()
+
+    tracker.completionTimes.clear()
+    self.assertEqual(tracker.getFramesPerSecond(), 0.0)
+    tracker.completionTimes.extend([10.0, 10.5, 11.0])
+    self.assertAlmostEqual(tracker.getFramesPerSecond(), 2.0)
+    self.delayDisplay('Test passed!')
+
+  def test_ResultCache(self):
+    """ Results should be evicted least recently used first, kept on disk across logic instances,
+    and unreadable cache files should be ignored.
+    """
+    self.delayDisplay("Starting the result cache test")
+    logic = StaticNeedleSegmentationLogic()
+    logic.resultCacheSize = 2
+    logic.storeCachedResult('a', '1 2 3 4 5 6')
+    logic.storeCachedResult('b', '1 2 3 4 5 6')
+    self.assertIsNotNone(logic.getCachedResult('a'))
+    logic.storeCachedResult('c', '1 2 3 4 5 6')
+    self.assertIsNone(logic.getCachedResult('b'))
+    self.assertIsNotNone(logic.getCachedResult('a'))
+    self.assertEqual(logic.getResultCacheStatistics()['size'], 2)
+    logic.invalidateResultCache()
+    self.assertEqual(logic.getResultCacheStatistics()['size'], 0)
+
+    temporaryDirectory = tempfile.mkdtemp(prefix='StaticNeedleSegmentationTest-')
+    try:
+      volumeNode, tip, tail = self.createNeedleVolume(32)
+      seedNode = slicer.vtkMRMLMarkupsFiducialNode()
+      slicer.mrmlScene.AddNode(seedNode)
+      seedNode.AddFiducialFromArray(list((tip + tail) / 2.0))
+      outputNode = slicer.vtkMRMLMarkupsFiducialNode()
+      slicer.mrmlScene.AddNode(outputNode)
+      def run(logic):
+        logic.backendName = 'numpy'
+        logic.resultCacheDirectory = temporaryDirectory
+        return logic.run(volumeNode, seedNode, outputNode, None, self.getInsertAngle(tip, tail), False)
+      self.assertFalse(run(logic).resultCacheHit)
+      self.assertTrue(run(logic).resultCacheHit)
+      self.assertEqual(len(os.listdir(temporaryDirectory)), 1)
+
+      # another logic finds the result on disk, but not in a corrupt file
+      otherLogic = StaticNeedleSegmentationLogic()
+      self.assertTrue(run(otherLogic).resultCacheHit)
+      self.assertEqual(otherLogic.getResultCacheStatistics()['diskHits'], 1)
+      with open(os.path.join(temporaryDirectory, os.listdir(temporaryDirectory)[0]), 'w') as resultFile:
+        resultFile.write('{"key": ')
+      otherLogic = StaticNeedleSegmentationLogic()
+      self.assertFalse(run(otherLogic).resultCacheHit)
+      self.assertEqual(outputNode.GetNumberOfFiducials(), 2)
+
+      otherLogic.invalidateResultCache()
+      self.assertEqual(os.listdir(temporaryDirectory), [])
+      otherLogic.cleanup()
+      logic.cleanup()
+    finally:
+      shutil.rmtree(temporaryDirectory, ignore_errors=True)
+    self.delayDisplay('Test passed!')
+
+  def test_NumpyBackend(self):
+    """ The NumPy backend should find the needle through the seed, and reject it at a different insertion angle.
+    """
+    self.delayDisplay("Starting the NumPy backend test")
+    logic = StaticNeedleSegmentationLogic()
+    logic.enableResultCache = False
+    volumeNode, tip, tail = self.createNeedleVolume(48)
+    seed = list((tip + tail) / 2.0)
+    insertAngle = self.getInsertAngle(tip, tail)
+
+    segmentationRun = logic.prepareRun(volumeNode, seed, insertAngle, backend='numpy')
+    try:
+      results = logic.parseResults(segmentationRun.backend.segment(logic, segmentationRun, segmentationRun.seedPoint))
+    finally:
+      logic.releaseRun(segmentationRun)
+    self.assertEqual(len(results), 1)
+    self.assertLess(numpy.linalg.norm(numpy.array(results[0].tip) - tip), 1.5)
+    self.assertLess(numpy.linalg.norm(numpy.array(results[0].tail) - tail), 1.5)
+    self.assertGreater(results[0].confidence, 0.5)
+
+    segmentationRun = logic.prepareRun(volumeNode, seed, insertAngle + 45.0, backend='numpy')
+    try:
+      with self.assertRaises(ValueError):
+        segmentationRun.backend.segment(logic, segmentationRun, segmentationRun.seedPoint)
+    finally:
+      logic.releaseRun(segmentationRun)
+    logic.cleanup()
+    self.delayDisplay('Test passed!')
+
+  def waitForTracker(self, tracker, framesSegmented, timeout=30.0):
+    """Processes events until tracker has segmented framesSegmented frames and is idle
+    """
+    startTime = time.time()
+    while (tracker.framesSegmented < framesSegmented or tracker.logic.isRunning() or
+           tracker.debounceTimer.isActive() or tracker.framePending):
+      self.assertLess(time.time() - startTime, timeout)
+      slicer.app.processEvents()
+      time.sleep(0.01)
+    self.assertEqual(tracker.framesSegmented, framesSegmented)
+
+  @classmethod
+  def createNeedleVolume(cls, size):
+    """Returns a volume node with Rayleigh distributed speckle and a bright needle,
+    and the RAS coordinates of the needle tip and tail
+    """
+    randomState = numpy.random.RandomState(size)
+    voxels = numpy.clip(randomState.rayleigh(20.0, (size, size, size)), 0, 120).astype(numpy.uint8)
+    tailIndex = numpy.array(cls.needleTailFraction) * (size - 1)
+    tipIndex = numpy.array(cls.needleTipFraction) * (size - 1)
+    numberOfSamples = int(4 * numpy.linalg.norm(tipIndex - tailIndex)) + 1
+    for t in numpy.linspace(0.0, 1.0, numberOfSamples):
+      i, j, k = numpy.round(tailIndex + t * (tipIndex - tailIndex)).astype(int)
+      voxels[max(k - 1, 0):k + 2, max(j - 1, 0):j + 2, max(i - 1, 0):i + 2] = 200
+      voxels[k, j, i] = 255
+
+    volumeNode = slicer.vtkMRMLScalarVolumeNode()
+    volumeNode.SetName('SyntheticNeedle{0}'.format(size))
+    volumeNode.SetSpacing(cls.needleVolumeSpacing, cls.needleVolumeSpacing, cls.needleVolumeSpacing)
+    slicer.mrmlScene.AddNode(volumeNode)
+    slicer.util.updateVolumeFromArray(volumeNode, voxels)
+    return volumeNode, tipIndex * cls.needleVolumeSpacing, tailIndex * cls.needleVolumeSpacing
+
+  @staticmethod
+  def getInsertAngle(tip, tail):
+    direction = (tip - tail) / numpy.linalg.norm(tip - tail)
+    return numpy.degrees(numpy.arccos(-direction[1]))
+
+  def test_ReseedRegion(self):
+    """ Seeds on the segmented needle should be recognized, others should get a region around the needle.
+    """
+    self.delayDisplay("Starting the reseed region test")
+    logic = StaticNeedleSegmentationLogic()
+    tip = [0.0, -20.0, 0.0]
+    tail = [0.0, 20.0, 0.0]
+    self.assertAlmostEqual(logic.distanceToSegment([1.0, 5.0, 0.0], tip, tail), 1.0)
+    self.assertAlmostEqual(logic.distanceToSegment([0.0, 23.0, 4.0], tip, tail), 5.0)
+    self.assertAlmostEqual(logic.distanceToSegment([3.0, 0.0, 4.0], tip, tip), 5.0)
+
+    volumeNode = slicer.vtkMRMLScalarVolumeNode()
+    volumeNode.SetSpacing(0.5, 0.5, 0.5)
+    volumeNode.SetOrigin(-50.0, -50.0, -50.0)
+    slicer.mrmlScene.AddNode(volumeNode)
+    slicer.util.updateVolumeFromArray(volumeNode, numpy.zeros((200, 200, 200), dtype=numpy.uint8))
+    roiExtent = logic.computePointsRoiExtent(volumeNode, [tip, tail, [5.0, 0.0, 0.0]], 10.0)
+    self.assertEqual(roiExtent, [80, 130, 40, 160, 80, 120])
+    self.assertEqual(logic.computePointsRoiExtent(volumeNode, [tip, tail], 100.0), None)
+    self.delayDisplay('Test passed!')
+
+  def test_NeedleModels(self):
+    """ Needles should extend to the volume bounds, and models should be updated rather than added.
+    """
+    self.delayDisplay("Starting the needle models test")
+    logic = StaticNeedleSegmentationLogic()
+    bounds = [-10.0, 10.0, -20.0, 20.0, 0.0, 30.0]
+    shaftEnds = logic.extrapolateToBounds([[0.0, -10.0, 10.0], [0.0, 0.0, 5.0], [0.0, 0.0, 5.0]],
+                                          [[0.0, 0.0, 10.0], [5.0, 0.0, 5.0], [0.0, 0.0, 40.0]], bounds)
+    numpy.testing.assert_allclose(shaftEnds, [[0.0, 20.0, 10.0], [10.0, 0.0, 5.0], [0.0, 0.0, 40.0]])
+
+    outputPoints = slicer.vtkMRMLMarkupsFiducialNode()
+    slicer.mrmlScene.AddNode(outputPoints)
+    logic.updateNeedleModels(outputPoints, [[0.0, -10.0, 10.0], [0.0, 0.0, 5.0]], shaftEnds[:2])
+    numberOfModels = slicer.mrmlScene.GetNumberOfNodesByClass('vtkMRMLModelNode')
+    logic.updateNeedleModels(outputPoints, [[1.0, -10.0, 10.0], [0.0, 1.0, 5.0]], shaftEnds[:2])
+    self.assertEqual(slicer.mrmlScene.GetNumberOfNodesByClass('vtkMRMLModelNode'), numberOfModels)
+    modelNode = slicer.mrmlScene.GetNodeByID(logic.needleModels[(outputPoints.GetID(), 0)][0])
+    self.assertGreater(modelNode.GetPolyData().GetBounds()[1], 1.5)  # tip moved from x=0 to x=1
+    logic.updateNeedleModels(outputPoints, [[1.0, -10.0, 10.0]], shaftEnds[:1])
+    self.assertEqual(slicer.mrmlScene.GetNumberOfNodesByClass('vtkMRMLModelNode'), numberOfModels - 1)
+    self.delayDisplay('Test passed!')
+
+  def test_VolumeTransform(self):
+    """ Cached volume transforms should follow changes of the parent transform.
+    """
+    self.delayDisplay("Starting the volume transform test")
+    volumeNode = slicer.vtkMRMLScalarVolumeNode()
+    slicer.mrmlScene.AddNode(volumeNode)
+    volumeNode.SetIJKToRASDirections(-1, 0, 0, 0, -1, 0, 0, 0, 1)
+    transformNode = slicer.vtkMRMLLinearTransformNode()
+    slicer.mrmlScene.AddNode(transformNode)
+    volumeNode.SetAndObserveTransformNodeID(transformNode.GetID())
+    volumeTransform = StaticNeedleSegmentationVolumeTransform(volumeNode)
+
+    points = numpy.array([[1.0, 2.0, 3.0], [-4.0, 5.0, 6.0]])
+    numpy.testing.assert_allclose(volumeTransform.worldToImage(points), points * [-1.0, -1.0, 1.0])
+    matrix = vtk.vtkMatrix4x4()
+    matrix.SetElement(0, 3, 10.0)
+    transformNode.SetMatrixTransformToParent(matrix)
+    numpy.testing.assert_allclose(volumeTransform.worldToImage(points), (points - [10.0, 0.0, 0.0]) * [-1.0, -1.0, 1.0])
+    numpy.testing.assert_allclose(volumeTransform.imageToWorld(volumeTransform.worldToImage(points)), points)
+    volumeTransform.release()
+    self.delayDisplay('Test passed!')
+
+  def test_ResultParser(self):
+    """ Framed results should be parsed from chunked output with log lines, legacy output should still be read.
+    """
+    self.delayDisplay("Starting the result parser test")
+    result = StaticNeedleSegmentationResult([1.0, 2.0, 3.0], [4.0, 5.0, 6.0], [[4.0, 5.0, 6.0], [1.0, 2.0, 3.0]],
+                                            0.75, {'filter': 0.5})
+    output = 'Loading image\n' + result.toMessage() + '\nDone in 2 s\n'
+    parser = StaticNeedleSegmentationResultParser()
+    parser.feed(output[:30])
+    parser.feed(output[30:])
+    results = parser.close()
+    self.assertEqual(len(results), 1)
+    self.assertEqual(results[0].tail, [4.0, 5.0, 6.0])
+    self.assertEqual(results[0].centerline, [[4.0, 5.0, 6.0], [1.0, 2.0, 3.0]])
+    self.assertEqual(results[0].confidence, 0.75)
+    self.assertEqual(results[0].timings['filter'], 0.5)
+
+    parser = StaticNeedleSegmentationResultParser()
+    parser.feed('Iterations: 3\n1 2 3 4 5 6')
+    results = parser.close()
+    self.assertEqual([(result.tip, result.tail) for result in results], [([1.0, 2.0, 3.0], [4.0, 5.0, 6.0])])
+    self.assertEqual(results[0].confidence, None)
+
+    # legacy output with tip and tail on separate lines, or after a numeric log line
+    for output in ['1 2 3\n4 5 6\n', '0.5\n1 2 3 4 5 6\n']:
+      parser = StaticNeedleSegmentationResultParser()
+      parser.feed(output)
+      results = parser.close()
+      self.assertEqual([(result.tip, result.tail) for result in results], [([1.0, 2.0, 3.0], [4.0, 5.0, 6.0])])
+
+    # a tip without its tail, or points without 3 coordinates, must not be read as a result
+    parser = StaticNeedleSegmentationResultParser()
+    parser.feed('1 2 3\n4 5 6\n7 8 9\n')
+    self.assertRaises(ValueError, parser.close)
+    parser = StaticNeedleSegmentationResultParser()
+    self.assertRaises(ValueError, parser.feed, 'NEEDLE_RESULT {"tip": [1, 2], "tail": [4, 5, 6]}\n')
+    self.delayDisplay('Test passed!')
+
+#
+# Command line interface
+#
+
+def main(argv):
+  """Segments the volumes listed in a CSV manifest without the user interface, for example:
+  Slicer --no-main-window --python-script StaticNeedleSegmentation.py --manifest cases.csv --results results.csv
+  """
+  logic = StaticNeedleSegmentationLogic()
+  parser = argparse.ArgumentParser(description='Segment needles in a batch of volumes listed in a CSV manifest.')
+  parser.add_argument('--manifest', required=True,
+                      help='CSV file with columns ' + ', '.join(StaticNeedleSegmentationLogic.batchManifestColumns))
+  parser.add_argument('--results', help='CSV file the results are written to as they complete')
+  parser.add_argument('--workers', type=int, default=None, help='number of parallel segmentations (default: number of CPUs)')
+  parser.add_argument('--roi', action='store_true', help='only export a region around each seed')
+  parser.add_argument('--executable', help='path of the segmentation executable')
+  parser.add_argument('--scratch', help='directory for temporary files, e.g. /dev/shm')
+  parser.add_argument('--raw', action='store_true', help='pass images as uncompressed .mhd/.raw files written without copying')
+  parser.add_argument('--metrics', help='CSV file the metrics of segmentations with a manual tip are appended to')
+  parser.add_argument('--report', help='file the timing report of every segmentation is appended to, as JSON lines')
+  parser.add_argument('--backend', default=logic.backendName, choices=list(logic.backends.keys()),
+                      help='segmentation algorithm: ' + '; '.join(backend.name + ': ' + backend.description
+                                                                 for backend in logic.backends.values()))
+  args = parser.parse_args(argv)
+
+  if args.executable:
+    logic.executablePath = args.executable
+  if args.scratch:
+    logic.setScratchRoot(args.scratch)
+  if args.raw:
+    logic.exportFormat = 'raw'
+  if args.report:
+    logic.runReportFileName = args.report
+  if args.metrics:
+    logic.metricsSink.fileName = args.metrics
+  logic.backendName = args.backend
+  try:
+    results = logic.runBatch(logic.readBatchManifest(args.manifest), args.workers, args.results, args.roi)
+  finally:
+    logic.cleanup()
+  numberOfFailures = len([result for result in results if result['error']])
+  print("Segmented {0} volumes, {1} failed.".format(len(results) - numberOfFailures, numberOfFailures))
+  return 1 if numberOfFailures else 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,252 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import logging
+import numpy
+import vtk, slicer
+from slicer.ScriptedLoadableModule import *
+from StaticNeedleSegmentation import StaticNeedleSegmentationLogic, StaticNeedleSegmentationTest
+
+#
+# StaticNeedleSegmentationBenchmark
+#
+
+class StaticNeedleSegmentationBenchmark(ScriptedLoadableModuleTest):
+  """Times the segmentation pipeline on synthetic ultrasound-like volumes, using
+  StaticNeedleTestBedStandIn.py instead of the real executable so that it runs offline.
+
+  Timings are compared to the baseline file named by STATIC_NEEDLE_SEGMENTATION_BENCHMARK_BASELINE,
+  by default StaticNeedleSegmentationBenchmarkBaseline.json next to this script. A measurement
+  slower than regressionTolerance times its baseline, or missing from the baseline, fails the test.
+  The measurements are written to StaticNeedleSegmentationBenchmarkMeasurements.json in the Slicer
+  temporary directory; they replace those of the baseline file when STATIC_NEEDLE_SEGMENTATION_UPDATE_BASELINE is set.
+  Timings depend on the machine, so the benchmark is only registered as a test when
+  StaticNeedleSegmentation_BUILD_BENCHMARK is enabled in CMake.
+  """
+
+  # Edge length (voxels) of the synthetic volumes
+  volumeSizes = [64, 128, 192]
+  # A measurement fails if it takes longer than baseline * regressionTolerance + regressionSlack seconds
+  regressionTolerance = 1.5
+  regressionSlack = 0.05
+  # Maximum distance (mm) between the segmented and the embedded tip/tail
+  accuracyTolerance = 2.0
+
+  def setUp(self):
+    slicer.mrmlScene.Clear(0)
+    self.measurements = {}
+    self.temporaryDirectory = tempfile.mkdtemp(prefix='StaticNeedleSegmentationBenchmark-')
+
+  def tearDown(self):
+    shutil.rmtree(self.temporaryDirectory, ignore_errors=True)
+
+  def runTest(self):
+    """Run as few or as many tests as needed here.
+    """
+    self.setUp()
+    self.test_RunBenchmark()
+    self.tearDown()
+    self.setUp()
+    self.test_MetricsBenchmark()
+    self.tearDown()
+    self.setUp()
+    self.test_BatchBenchmark()
+    self.tearDown()
+
+  def test_RunBenchmark(self):
+    """ Times run on volumes of increasing size: first run, exported image reused,
+    cached result, cropped region, raw export, one-shot executable calls, the NumPy backend,
+    coarse to fine segmentation and several seeds on the same needle.
+    """
+    self.delayDisplay("Starting the run benchmark")
+    for size in self.volumeSizes:
+      volumeNode, tip, tail = StaticNeedleSegmentationTest.createNeedleVolume(size)
+      seedNode = self.createFiducials('Seed', [(tip + tail) / 2.0])
+      outputNode = self.createFiducials('Output', [])
+      manualTipNode = self.createFiducials('ManualTip', [tip])
+      insertAngle = StaticNeedleSegmentationTest.getInsertAngle(tip, tail)
+
+      logic = self.createLogic()
+      logic.enableResultCache = False
+      def run(enableRoi=False, backend=None, pyramid=False):
+        logic.run(volumeNode, seedNode, outputNode, manualTipNode, insertAngle, False, enableRoi=enableRoi, backend=backend,
+                  pyramid=pyramid)
+
+      self.measure('run/{0}/first'.format(size), run, repeat=1)
+      self.checkOutput(outputNode, tip, tail)
+      self.measure('run/{0}/exportCached'.format(size), run)
+      self.measure('run/{0}/roi'.format(size), lambda: run(enableRoi=True))
+      self.checkOutput(outputNode, tip, tail)
+
+      logic.useWorker = False
+      logic.stopWorker()
+      self.measure('run/{0}/oneShot'.format(size), run)
+
+      logic.useWorker = True
+      logic.exportFormat = 'raw'
+      def runRaw():
+        logic.clearExportCache()
+        run()
+      self.measure('run/{0}/rawExport'.format(size), runRaw)
+      self.checkOutput(outputNode, tip, tail)
+
+      self.measure('run/{0}/pyramid'.format(size), lambda: run(pyramid=True))
+      self.checkOutput(outputNode, tip, tail)
+
+      self.measure('run/{0}/numpyBackend'.format(size), lambda: run(backend='numpy'))
+      self.checkOutput(outputNode, tip, tail)
+
+      multiSeedNode = self.createFiducials('Seeds', [tail + fraction * (tip - tail) for fraction in [0.3, 0.5, 0.7]])
+      self.measure('run/{0}/multiSeed3'.format(size), lambda: logic.run(volumeNode, multiSeedNode, outputNode, None,
+                                                                         insertAngle, False, multiSeed=True))
+      self.assertEqual(outputNode.GetNumberOfFiducials(), 6)
+      self.assertEqual(outputNode.GetNthFiducialLabel(4), 'Tip 3')
+
+      logic.enableResultCache = True
+      run()
+      self.measure('run/{0}/resultCached'.format(size), run)
+      self.assertTrue(logic.lastRunReport.resultCacheHit)
+
+      logic.cleanup()
+      slicer.mrmlScene.Clear(0)
+    self.checkBaseline()
+    self.delayDisplay('Test passed!')
+
+  def test_MetricsBenchmark(self):
+    """ Times the metrics computation, per needle and vectorized
+    """
+    self.delayDisplay("Starting the metrics benchmark")
+    logic = StaticNeedleSegmentationLogic()
+    randomState = numpy.random.RandomState(0)
+    numberOfNeedles = 10000
+    tails = randomState.uniform(-50.0, 50.0, (numberOfNeedles, 3))
+    tips = tails + [0.0, -60.0, 40.0] + randomState.normal(0.0, 2.0, (numberOfNeedles, 3))
+    manualTips = tips + randomState.normal(0.0, 1.0, (numberOfNeedles, 3))
+
+    manualTipNode = self.createFiducials('ManualTip', [manualTips[0]])
+    def compareOneByOne():
+      for index in range(100):
+        logic.compareToManualSeg(tips[index], tails[index], manualTipNode, 45.0)
+    self.measure('compareToManualSeg/100', compareOneByOne, repeat=1)
+    self.measure('computeMetricsArray/{0}'.format(numberOfNeedles),
+                 lambda: logic.computeMetricsArray(tips, tails, manualTips, 45.0))
+    metrics = logic.computeMetricsArray(tips, tails, manualTips, 45.0)
+    self.measure('addMetricsRows/{0}'.format(numberOfNeedles), lambda: logic.addMetricsRows(metrics), repeat=1)
+    self.checkBaseline()
+    self.delayDisplay('Test passed!')
+
+  def test_BatchBenchmark(self):
+    """ Times a batch of saved volumes with one and with several workers
+    """
+    self.delayDisplay("Starting the batch benchmark")
+    size = self.volumeSizes[0]
+    numberOfVolumes = 8
+    manifestRows = []
+    for index in range(numberOfVolumes):
+      volumeNode, tip, tail = StaticNeedleSegmentationTest.createNeedleVolume(size)
+      fileName = os.path.join(self.temporaryDirectory, 'volume{0}.nrrd'.format(index))
+      slicer.util.saveNode(volumeNode, fileName)
+      slicer.mrmlScene.RemoveNode(volumeNode)
+      manifestRows.append({'volume': fileName, 'seed': list((tip + tail) / 2.0), 'manualTip': list(tip),
+                           'insertAngle': StaticNeedleSegmentationTest.getInsertAngle(tip, tail)})
+
+    for numberOfWorkers in [1, 4]:
+      logic = self.createLogic()
+      logic.enableResultCache = False
+      resultsFileName = os.path.join(self.temporaryDirectory, 'results{0}.csv'.format(numberOfWorkers))
+      results = []
+      def runBatch():
+        results[:] = logic.runBatch(manifestRows, numberOfWorkers, resultsFileName)
+      self.measure('runBatch/{0}x{1}/workers{2}'.format(numberOfVolumes, size, numberOfWorkers), runBatch, repeat=1)
+      self.assertEqual(len(results), numberOfVolumes)
+      self.assertFalse([result for result in results if result['error']])
+      logic.cleanup()
+    self.checkBaseline()
+    self.delayDisplay('Test passed!')
+
+  def createFiducials(self, name, points):
+    fiducialNode = slicer.vtkMRMLMarkupsFiducialNode()
+    fiducialNode.SetName(name)
+    slicer.mrmlScene.AddNode(fiducialNode)
+    for point in points:
+      fiducialNode.AddFiducialFromArray(list(point))
+    return fiducialNode
+
+  def createLogic(self):
+    logic = StaticNeedleSegmentationLogic()
+    logic.executablePath = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'StaticNeedleTestBedStandIn.py')
+    logic.executableLauncher = self.getPythonInterpreter()
+    return logic
+
+  def getPythonInterpreter(self):
+    """Returns the Python interpreter that runs the stand-in executable
+    """
+    for name in ['PythonSlicer', 'PythonSlicer.exe', 'python-real', 'python-real.exe']:
+      interpreter = os.path.join(slicer.app.slicerHome, 'bin', name)
+      if os.path.exists(interpreter):
+        return interpreter
+    return sys.executable
+
+  def checkOutput(self, outputNode, tip, tail):
+    self.assertEqual(outputNode.GetNumberOfFiducials(), 2)
+    for index, expected in enumerate([tip, tail]):
+      position = [0.0, 0.0, 0.0]
+      outputNode.GetNthFiducialPosition(index, position)
+      self.assertLess(numpy.linalg.norm(numpy.array(position) - expected), self.accuracyTolerance)
+
+  def measure(self, name, function, repeat=3):
+    """Calls function repeat times and records the shortest duration under name
+    """
+    durations = []
+    for iteration in range(repeat):
+      startTime = time.time()
+      function()
+      durations.append(time.time() - startTime)
+    self.measurements[name] = min(durations)
+    logging.info('Benchmark {0}: {1:.4f} s'.format(name, self.measurements[name]))
+
+  def getBaselineFileName(self):
+    return os.environ.get('STATIC_NEEDLE_SEGMENTATION_BENCHMARK_BASELINE') or \
+      os.path.join(os.path.dirname(os.path.realpath(__file__)), 'StaticNeedleSegmentationBenchmarkBaseline.json')
+
+  def getMeasurementsFileName(self):
+    return os.path.join(slicer.app.temporaryPath, 'StaticNeedleSegmentationBenchmarkMeasurements.json')
+
+  def updateJsonFile(self, fileName, measurements):
+    """Adds measurements to those of a JSON file, creating it if needed
+    """
+    values = {}
+    if os.path.exists(fileName):
+      with open(fileName) as jsonFile:
+        values = json.load(jsonFile)
+    values.update(measurements)
+    with open(fileName, 'w') as jsonFile:
+      json.dump(values, jsonFile, indent=2, sort_keys=True)
+
+  def checkBaseline(self):
+    """Records the measurements, and fails if one of them regressed compared to the baseline or has no baseline
+    """
+    self.updateJsonFile(self.getMeasurementsFileName(), self.measurements)
+    baselineFileName = self.getBaselineFileName()
+    if os.environ.get('STATIC_NEEDLE_SEGMENTATION_UPDATE_BASELINE'):
+      self.updateJsonFile(baselineFileName, self.measurements)
+      logging.info('Benchmark baseline updated: ' + baselineFileName)
+      return
+
+    baseline = {}
+    if os.path.exists(baselineFileName):
+      with open(baselineFileName) as baselineFile:
+        baseline = json.load(baselineFile)
+    regressions = []
+    for name, seconds in sorted(self.measurements.items()):
+      if name not in baseline:
+        regressions.append('{0}: {1:.4f} s, no baseline'.format(name, seconds))
+        continue
+      allowedSeconds = baseline[name] * self.regressionTolerance + self.regressionSlack
+      if seconds > allowedSeconds:
+        regressions.append('{0}: {1:.4f} s, baseline {2:.4f} s'.format(name, seconds, baseline[name]))
+    self.assertFalse(regressions, 'Performance regressions compared to ' + baselineFileName + ': ' + '; '.join(regressions) +
+                     ' (measurements in ' + self.getMeasurementsFileName() + ')')
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""Stand-in for the StaticNeedleTestBed segmentation executable, used to test and
+benchmark the module without the (unpublished) algorithm.
+
+Usage:
+  StaticNeedleTestBedStandIn.py [--legacy] <image.mha|image.mhd> <seed x> <seed y> <seed z>
+  StaticNeedleTestBedStandIn.py [--legacy] --worker
+
+It prints the needle found, in the physical coordinates of the image, as a framed
+result line: NEEDLE_RESULT {"tip": [...], "tail": [...], "centerline": [...],
+"confidence": ..., "timings": {...}}, preceded by a log line. With --legacy it prints
+"<tip x> <tip y> <tip z> <tail x> <tail y> <tail z>" like the real executable.
+The needle is found by thresholding the brightest voxels near the seed and fitting
+a line to them. In worker mode it prints READY, then answers one
+"<image path> <seed x> <seed y> <seed z>" request per line until an empty line is read.
+"""
+
+import os
+import sys
+import json
+import time
+import numpy
+
+# numpy scalar types of MetaImage element types
+elementTypes = {'MET_CHAR': numpy.int8, 'MET_UCHAR': numpy.uint8, 'MET_SHORT': numpy.int16, 'MET_USHORT': numpy.uint16,
+                'MET_INT': numpy.int32, 'MET_UINT': numpy.uint32, 'MET_LONG_LONG': numpy.int64,
+                'MET_ULONG_LONG': numpy.uint64, 'MET_FLOAT': numpy.float32, 'MET_DOUBLE': numpy.float64}
+
+# Voxels brighter than this fraction of the maximum intensity are considered part of the needle
+thresholdFraction = 0.6
+# Only bright voxels within this distance (mm) of the seed are used
+searchRadius = 100.0
+# Bright voxels within this distance (mm) of the fitted line count towards the confidence
+inlierDistance = 1.5
+# Number of centreline points reported
+numberOfCenterlinePoints = 5
+
+
+def readMetaImage(fileName):
+  """Reads an uncompressed MetaImage file. Returns the voxel array (k, j, i order),
+  the spacing and the origin.
+  """
+  header = {}
+  with open(fileName, 'rb') as imageFile:
+    while True:
+      line = imageFile.readline()
+      if not line:
+        raise IOError('Incomplete MetaImage header in ' + fileName)
+      key, _, value = line.decode('latin-1').partition('=')
+      header[key.strip()] = value.strip()
+      if key.strip() == 'ElementDataFile':
+        break
+    dataOffset = imageFile.tell()
+
+  if header.get('CompressedData', 'False') == 'True':
+    raise IOError('Compressed MetaImage files are not supported')
+  dimensions = [int(d) for d in header['DimSize'].split()]
+  spacing = [float(s) for s in header.get('ElementSpacing', '1 1 1').split()]
+  origin = [float(o) for o in header.get('Offset', header.get('Origin', '0 0 0')).split()]
+  numberOfComponents = int(header.get('ElementNumberOfChannels', '1'))
+  dtype = numpy.dtype(elementTypes[header['ElementType']])
+  if header.get('BinaryDataByteOrderMSB', 'False') == 'True':
+    dtype = dtype.newbyteorder('>')
+  else:
+    dtype = dtype.newbyteorder('<')
+
+  dataFileName = header['ElementDataFile']
+  if dataFileName == 'LOCAL':
+    dataFileName = fileName
+  else:
+    dataFileName = os.path.join(os.path.dirname(fileName), dataFileName)
+    dataOffset = 0
+  count = dimensions[0] * dimensions[1] * dimensions[2] * numberOfComponents
+  with open(dataFileName, 'rb') as dataFile:
+    dataFile.seek(dataOffset)
+    voxels = numpy.fromfile(dataFile, dtype=dtype, count=count)
+  voxels = voxels.reshape(dimensions[2], dimensions[1], dimensions[0], numberOfComponents)[..., 0]
+  return voxels, spacing, origin
+
+
+def segment(imageFileName, seedPoint):
+  """Returns tip and tail of the bright line closest to seedPoint, the fraction
+  of bright voxels on it and the duration of each stage
+  """
+  timings = {}
+  startTime = time.time()
+  voxels, spacing, origin = readMetaImage(imageFileName)
+  timings['read'] = time.time() - startTime
+  startTime = time.time()
+  threshold = voxels.min() + thresholdFraction * (float(voxels.max()) - voxels.min())
+  k, j, i = numpy.nonzero(voxels > threshold)
+  points = numpy.column_stack((i, j, k)) * spacing + origin
+  points = points[numpy.linalg.norm(points - seedPoint, axis=1) < searchRadius]
+  if len(points) < 2:
+    raise ValueError('No needle found near the seed point')
+
+  # principal direction of the bright voxels
+  center = points.mean(axis=0)
+  direction = numpy.linalg.svd(points - center, full_matrices=False)[2][0]
+  projections = (points - center).dot(direction)
+  ends = [center + projections.min() * direction, center + projections.max() * direction]
+  # the tip is the posterior end (needles are inserted along -A, see compareToManualSeg)
+  tip, tail = sorted(ends, key=lambda point: point[1])
+  distances = numpy.linalg.norm((points - center) - numpy.outer(projections, direction), axis=1)
+  confidence = float(numpy.count_nonzero(distances <= inlierDistance)) / len(points)
+  timings['segment'] = time.time() - startTime
+  return tip, tail, confidence, timings
+
+
+def formatResult(tip, tail, confidence, timings, legacy=False):
+  if legacy:
+    return ' '.join('{0:.6f}'.format(c) for c in list(tip) + list(tail))
+  centerline = [list(tail + t * (tip - tail)) for t in numpy.linspace(0.0, 1.0, numberOfCenterlinePoints)]
+  result = {'tip': list(tip), 'tail': list(tail), 'centerline': centerline, 'confidence': confidence, 'timings': timings}
+  return 'Needle found\nNEEDLE_RESULT ' + json.dumps(result)
+
+
+def runWorker(legacy=False):
+  sys.stdout.write('READY\n')
+  sys.stdout.flush()
+  while True:
+    line = sys.stdin.readline()
+    if not line.strip():
+      break
+    try:
+      fields = line.rsplit(None, 3)
+      result = segment(fields[0], numpy.array([float(c) for c in fields[1:4]]))
+      sys.stdout.write(formatResult(*result, legacy=legacy) + '\n')
+    except Exception as e:
+      sys.stdout.write('ERROR ' + str(e).replace('\n', ' ') + '\n')
+    sys.stdout.flush()
+
+
+def main(argv):
+  legacy = '--legacy' in argv
+  argv = [argument for argument in argv if argument != '--legacy']
+  if len(argv) == 1 and argv[0] == '--worker':
+    runWorker(legacy)
+    return 0
+  if len(argv) != 4:
+    sys.stderr.write(__doc__)
+    return 1
+  result = segment(argv[0], numpy.array([float(c) for c in argv[1:4]]))
+  print(formatResult(*result, legacy=legacy))
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))